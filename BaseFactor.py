@@ -5,20 +5,104 @@
 @time:2021/11/28
 因子平台主文件，定义了因子基类，所有后续因子都建立在继承基类作为父类的基础上。
 """
-import pickle
+import gc
 import time
 import numpy as np
 import pandas as pd
 import os
 import sys
-import pymongo
-from multiprocessing import Pool
 
 sys.path.append('/home/lzy01/FactorBase/Code')
 from mongodb_utils import *
 from Helper import *
+from parallel_utils import *
 
-client = pymongo.MongoClient(host='localhost', port=27017)
+# 数据库连接，第一次使用时才建立
+client = LazyClient()
+
+
+class FactorMatrix(object):
+    __doc__ = """
+    因子结果矩阵，用于收集计算结果：
+        * 预先分配 shape = [交易日数, ticker数] 的float数组，worker返回的结果直接按(交易日位置, ticker位置)写入
+        * 出现新的ticker时按倍数扩容
+        * computed记录每个(交易日, ticker)是否计算过：计算结果为NaN（或inf被清洗为NaN）的格子按nan_policy储存，
+          没有计算的格子不会储存
+    """
+
+    def __init__(self, trading_days: list, codes=None) -> None:
+        """
+        :param trading_days: 计算因子的交易日
+        :param codes: 预计出现的ticker，可以为空，出现新ticker时自动扩容
+        """
+        self.trading_days = list(trading_days)
+        self.__day_pos = {dt: i for i, dt in enumerate(self.trading_days)}
+        self.codes = []
+        self.__code_pos = {}
+        self.values = np.full((len(self.trading_days), max(len(codes or []), 1)), np.nan)
+        self.computed = np.zeros(self.values.shape, dtype=bool)
+        self.code_ids(codes or [])
+        return
+
+    def __len__(self):
+        # 已计算的（交易日，ticker）数量
+        return int(np.count_nonzero(self.computed))
+
+    def code_ids(self, codes) -> np.ndarray:
+        """
+        返回ticker在矩阵中的列位置，新的ticker追加在最后
+        """
+        ids = np.empty(len(codes), dtype=np.int64)
+        for i, code in enumerate(codes):
+            k = self.__code_pos.get(code)
+            if k is None:
+                k = self.__code_pos[code] = len(self.codes)
+                self.codes.append(code)
+            ids[i] = k
+        if len(self.codes) > self.values.shape[1]:
+            grown = np.full((self.values.shape[0], max(len(self.codes), 2 * self.values.shape[1])), np.nan)
+            grown[:, :self.values.shape[1]] = self.values
+            computed = np.zeros(grown.shape, dtype=bool)
+            computed[:, :self.computed.shape[1]] = self.computed
+            self.values, self.computed = grown, computed
+        return ids
+
+    def write(self, block: pd.DataFrame, computed=None) -> None:
+        """
+        写入一段交易日的因子值
+
+        :param block: 交易日 × ticker 的因子矩阵，index为交易日 YYYY-MM-DD
+        :param computed: 与block形状相同的bool矩阵，标记计算过的格子，None表示非NaN的格子
+        """
+        rows = np.array([self.__day_pos[dt] for dt in block.index], dtype=np.int64)
+        cols = self.code_ids(list(block.columns))
+        self.values[np.ix_(rows, cols)] = block.values
+        self.computed[np.ix_(rows, cols)] = ~np.isnan(block.values) if computed is None else computed
+
+    def to_frame(self) -> pd.DataFrame:
+        """
+        宽格式的因子值（不拷贝），shape = [交易日数, ticker数]
+        """
+        return pd.DataFrame(
+            self.values[:, :len(self.codes)], index=self.trading_days, columns=self.codes, copy=False
+        )
+
+    def to_long(self, factor_name: str, nan_policy='keep') -> pd.DataFrame:
+        """
+        转换为按TRADE_DT排序的长格式，列为 [factor_name, 'S_INFO_WINDCODE', 'TRADE_DT']
+
+        :param nan_policy: 'keep': 计算结果为NaN的格子保留（储存为null）；'drop': 不保留
+        """
+        values = self.values[:, :len(self.codes)]
+        mask = self.computed[:, :len(self.codes)]
+        if nan_policy == 'drop':
+            mask = mask & ~np.isnan(values)
+        rows, cols = np.nonzero(mask)
+        return pd.DataFrame({
+            factor_name: values[rows, cols],
+            'S_INFO_WINDCODE': np.asarray(self.codes, dtype=object)[cols],
+            'TRADE_DT': np.asarray(self.trading_days, dtype=object)[rows]
+        })
 
 
 # 定义因子基础类
@@ -28,14 +112,20 @@ class BaseFactor(object):
         * 当创建新的因子时，需要继承此类，实现prepare_data,和generate_factor方法，具体输出要求参见各个方法说明
         * 当更新旧的因子时，按照创建新因子时的参数实现实例，调用self.__update_factor()
         * 支持日频，月频，季频，年频因子的生成和维护，不同频率通过覆写self._get_trading_days()函数实现
+        * 计算主要由numpy/scipy/BLAS等释放GIL的函数完成的因子，可以覆写executor = 'thread'，用多线程计算
     """
 
+    # 默认的执行方式：'process', 'thread' or 'serial'，见generate_factor_all
+    executor = 'process'
+
     def __init__(
             self,
             factor_name: str,
             factor_parameters: dict,
             save_db='basic_data',
-            trade_date_update=False
+            trade_date_update=False,
+            layout='row',
+            date_format='str'
     ) -> None:
         """
         :param factor_name:  (str)因子名，必须唯一
@@ -43,18 +133,44 @@ class BaseFactor(object):
         :param factor_parameters: (dict)因子计算使用到的自定义参数
         :param save_db: 数据存储db的名称
         :param mongoclient: MongoDB 数据库
+        :param layout: 新建collection时的储存格式，'row': 每个(ticker, 交易日)一个文档；
+                       'day': 每个交易日一个文档（见mongodb_utils.to_day_buckets）。已有数据的collection沿用原格式
+        :param date_format: 新建collection时TRADE_DT的储存格式，'str', 'date' or 'int'（见mongodb_utils.get_date_format），
+                            已有数据的collection沿用原格式
         """
 
         self.__factor_name = factor_name
         self.factor_param = factor_parameters
-        # 储存计算的factor值
-        self.__factor = []
+        # 储存计算的factor值（FactorMatrix）
+        self.__factor = None
+        # 断点续算模块
+        self.__checkpoint = None
+        # 计算结果为NaN的值是否储存，见clear_factor
+        self.__nan_policy = 'keep'
+        # 计算失败的交易日
+        self.__failed = []
         # 循环的trading_day
         self.__datetime = None
         # 储存存储因子的collection名称
         self.__save_db = save_db
-        # 初始化交易日模块
-        self.TD = TradeDate(check_update=trade_date_update)
+        # 交易日模块在第一次使用self.TD时才初始化，进程内共用
+        self.__trade_date_update = trade_date_update
+        # 新建collection时的储存格式
+        self.__layout = layout
+        self.__date_format = date_format
+
+    def __getstate__(self):
+        # 计算结果只保存在主进程中，pickle发送给worker时不包含
+        state = self.__dict__.copy()
+        state['_BaseFactor__factor'] = None
+        return state
+
+    @property
+    def TD(self) -> TradeDate:
+        """
+        交易日模块，进程内所有因子共用一个，第一次使用时才从数据库加载
+        """
+        return get_trade_date(check_update=self.__trade_date_update)
 
     def get_factor_name(self):
         """
@@ -64,12 +180,20 @@ class BaseFactor(object):
         """
         return self.__factor_name
 
+    def get_collection(self):
+        """
+        储存因子的collection
+
+        :return: pymongo collection
+        """
+        return client[self.__save_db][self.__factor_name]
+
     def get_trading_days(self, from_date, to_date) -> list:
         """
         获取计算因子的交易日历
 
         重写该函数可用于计算特定日期的因子， 如按月度进行计算
-        * 月度、季度、年度频率的因子请使用：TD.range_with_freq(sdt,edt,freq,is_start)
+        * 周度、月度、季度、年度频率的因子请使用：TD.range_with_freq(sdt,edt,freq,is_start)
 
         :param from_date: (str)起始时间
         :param to_date: (str)结束时间
@@ -100,37 +224,147 @@ class BaseFactor(object):
         """
         raise NotImplementedError
 
+    def generate_factor_batch(
+            self,
+            trading_days: list
+    ) -> pd.DataFrame:
+        """
+        .. note::
+           可选实现generate_factor_batch方法，一次计算一段连续交易日的因子。
+           返回一个DataFrame，shape = [d,n] where d is the num of trading days，index是交易日，columns是股票ticker，
+           当天没有计算的票记为NaN。默认逐日调用generate_factor
+
+        :param trading_days: 连续的交易日列表 YYYY-MM-DD
+        """
+        return self.__daily_batch(trading_days)[0]
+
+    def __daily_batch(self, trading_days: list):
+        """
+        逐日调用generate_factor，返回(因子矩阵, computed)，computed标记generate_factor返回了的格子（值可以是NaN）
+        """
+        series = [self.generate_factor(dt) for dt in trading_days]
+        block = pd.DataFrame(series, index=trading_days).astype(float)
+        computed = pd.DataFrame([pd.Series(True, index=x.index) for x in series], index=trading_days)
+        return block, computed.reindex(columns=block.columns).notna().values
+
+    def generate_factor_panel(
+            self,
+            sdt: str,
+            edt: str
+    ) -> pd.DataFrame:
+        """
+        .. note::
+           可选实现generate_factor_panel方法，用整个数据矩阵一次性计算sdt到edt所有交易日的因子。
+           返回一个DataFrame，shape = [d,n]，index是交易日，columns是股票ticker，未计算的票记为NaN。
+           子类实现后，generate_factor_all和update_factor优先使用该方法，不再逐日调用generate_factor
+
+        :param sdt: 起始交易日 YYYY-MM-DD
+        :param edt: 结束交易日 YYYY-MM-DD
+        """
+        raise NotImplementedError
+
+    def has_panel(self) -> bool:
+        """
+        子类是否实现了generate_factor_panel
+        """
+        return type(self).generate_factor_panel is not BaseFactor.generate_factor_panel
+
+    @staticmethod
+    def valid_window(panel: pd.DataFrame, window: int, max_nan: int) -> pd.DataFrame:
+        """
+        generate_factor_panel的筛选条件，与逐日计算时一致：当天有值，且过去window行中的缺失数小于max_nan
+
+        :param panel: 交易日 × ticker 的数据矩阵
+        :param window: 窗口长度（行数）
+        :param max_nan: 允许的最大缺失数（不含）
+        :return: 与panel形状相同的bool矩阵
+        """
+        nan_cnt = panel.isna().rolling(window, min_periods=1).sum()
+        return panel.notna() & (nan_cnt < max_nan)
+
+    @staticmethod
+    def rolling_mean(panel: pd.DataFrame, window: int) -> pd.DataFrame:
+        """
+        与逐日计算的np.nanmean一致的滚动均值：窗口内有inf时为inf（同时有inf和-inf时为NaN），
+        pandas的rolling mean累加时inf会污染之后的窗口，因此inf单独计数
+
+        :param panel: 交易日 × ticker 的数据矩阵
+        :param window: 窗口长度（行数）
+        :return: 与panel形状相同的矩阵
+        """
+        out = panel.replace([np.inf, -np.inf], np.nan).rolling(window, min_periods=1).mean()
+        pos = (panel == np.inf).rolling(window, min_periods=1).sum() > 0
+        neg = (panel == -np.inf).rolling(window, min_periods=1).sum() > 0
+        return out.mask(pos, np.inf).mask(neg, -np.inf).mask(pos & neg)
+
+    @staticmethod
+    def rolling_skew(panel: pd.DataFrame, window: int) -> pd.DataFrame:
+        """
+        与逐日计算的scipy.stats.skew(nan_policy='omit')一致的滚动偏度（有偏估计）：
+        方差为0（窗口内数值相同）时为NaN，只有两个观测值时为0，pandas的rolling skew分别为0和NaN
+
+        :param panel: 交易日 × ticker 的数据矩阵
+        :param window: 窗口长度（行数）
+        :return: 与panel形状相同的矩阵
+        """
+        rolling = panel.rolling(window, min_periods=1)
+        n = rolling.count()
+        # scipy判断方差为0的阈值
+        zero = rolling.var(ddof=0) <= (np.finfo(np.float64).resolution * rolling.mean()) ** 2
+        # pandas的rolling skew是无偏估计，转换为有偏估计
+        out = rolling.skew() * (n - 2) / np.sqrt(n * (n - 1))
+        return out.mask(n == 2, 0).mask(zero)
+
+    def window_rows(self, ordinals: np.ndarray, edt: str, lag: int) -> slice:
+        """
+        数据矩阵中edt及之前lag个交易日（共lag+1个交易日）对应的行，
+        与panel.loc[TD.offset(edt, -lag):edt]相同，但只做整数二分查找
+
+        :param ordinals: 数据矩阵每一行的交易日序号，见TradeDate.ordinal，需升序
+        :param edt: 结束交易日 YYYY-MM-DD
+        :param lag: 向前的交易日数
+        :return: 行的位置区间，可直接用于ndarray或DataFrame.iloc
+        """
+        end = self.TD.position(edt)
+        start = max(end - lag, 0)
+        return slice(int(np.searchsorted(ordinals, start, side='left')),
+                     int(np.searchsorted(ordinals, end, side='right')))
+
     def clear_factor(self, nan_policy='keep'):
         """
-        对当天的因子进行清洗，主要有:
-        1. 过滤掉无穷大和无穷小的值
-        2. 过滤掉nan值
+        对计算好的因子进行清洗，主要有:
+        1. 过滤掉无穷大和无穷小的值（替换为NaN）
+        2. 按nan_policy处理计算结果为NaN的值：'keep'储存为null，'drop'不储存。没有计算的(交易日, ticker)总是不储存
         .. todo::
            3. 过滤掉未上市的股票（未上市可能已经有财报发布，导致会出现一些值）
            4. 过滤掉已经退市的股票
 
         :return: 过滤后的因子值
         """
+        if nan_policy not in ['keep', 'drop']:
+            raise NotImplementedError('please enter the right nan_policy: "keep", "drop".')
+        self.__nan_policy = nan_policy
         if self.__factor is None or len(self.__factor) == 0:
             return
 
         # TODO 加入更多的filter
-        factor_se = self.__factor.replace([np.inf, -np.inf], np.nan)
-        try:
-            odd = np.nansum(np.isnan(factor_se[self.__factor_name])) / len(self.__factor)
-            print(f'Factor NaN pct = {round(odd * 100, 4)} %')
-        except KeyError:
-            print('Warning: factor data column name do not correspond to factor name, please check')
-            pass
+        self.__factor.values[np.isinf(self.__factor.values)] = np.nan
+        odd = np.count_nonzero(self.__factor.computed & np.isnan(self.__factor.values)) / len(self.__factor)
+        print(f'Factor NaN pct = {round(odd * 100, 4)} %')
 
-        if nan_policy == 'drop':
-            self.__factor = factor_se.dropna()
-        elif nan_policy == 'keep':
-            self.__factor = factor_se
+    def get_factor(self) -> pd.DataFrame:
+        """
+        获取计算好的因子值，长格式，列为 [因子名, 'S_INFO_WINDCODE', 'TRADE_DT']，按TRADE_DT排序
+
+        :return: pd.DataFrame
+        """
+        if self.__factor is None or len(self.__factor) == 0:
+            return pd.DataFrame(columns=[self.__factor_name, 'S_INFO_WINDCODE', 'TRADE_DT'])
+        return self.__factor.to_long(self.__factor_name, self.__nan_policy)
 
     def get_daily_result(self, dt):
         """
-        多线程计算辅助函数，用于获取每天的因子值，主体是.generate_factor()
+        单日计算辅助函数，用于获取某一天的因子值，主体是.generate_factor()
         :param dt:
         :return:
         """
@@ -144,23 +378,199 @@ class BaseFactor(object):
 
         return df
 
+    def get_block_result(self, trading_days):
+        """
+        多进程计算辅助函数，用于获取一段连续交易日的因子值，主体是.generate_factor_batch()
+        :param trading_days: 连续的交易日列表
+        :return: (交易日 × ticker 的因子矩阵, computed)，见FactorMatrix.write
+        """
+        t0 = time.time()
+        if type(self).generate_factor_batch is BaseFactor.generate_factor_batch:
+            result = self.__daily_batch(trading_days)
+        else:
+            result = (self.generate_factor_batch(trading_days), None)
+        print(f' >>> {trading_days[0]} ~ {trading_days[-1]} {self.__factor_name} calculation finished, '
+              f'Total Time = {round(time.time() - t0, 2)}s')
+
+        return result
+
+    def measure_ipc(self, trading_days, share_mode=None) -> int:
+        """
+        计算某种数据共享方式下，每个任务发送给worker的字节数，运行前提是已经运行了prepare_data()
+        'pickle'方式下会完整序列化一次因子对象（包括prepare_data准备的所有数据）
+
+        :param trading_days: 一个任务计算的交易日列表
+        :param share_mode: 数据共享方式，见generate_factor_all
+        :return: (int)每个任务的IPC字节数
+        """
+        if resolve_share_mode(share_mode) == 'pickle':
+            return task_ipc_bytes(self.get_block_result, (trading_days,))
+        return task_ipc_bytes(run_factor_task, (self.__factor_name, 'get_block_result', trading_days))
+
+    def start_calculation(self, process=1, block_size=None, checkpoint_path=None) -> list:
+        """
+        准备计算self.trading_days的因子：分配结果矩阵，读取断点，实现了generate_factor_panel的因子直接计算完成
+
+        :param process: 进程数，用于自动确定block_size
+        :param block_size: 每个任务的交易日数，见generate_factor_all
+        :param checkpoint_path: 断点储存目录，见generate_factor_all
+        :return: 需要发送给进程池计算的交易日块
+        """
+        self.__factor = FactorMatrix(self.trading_days, getattr(self, 'codes', None))
+        self.__failed = []
+        self.__checkpoint = None
+        if len(self.trading_days) == 0:
+            return []
+
+        # 读取断点中已经完成的交易日
+        done = set()
+        if checkpoint_path is not None:
+            self.__checkpoint = CheckPoint(checkpoint_path, self.__factor_name, self.factor_param,
+                                           self.trading_days[0], self.trading_days[-1])
+            for block, computed in self.__checkpoint.load():
+                self.__factor.write(block, computed)
+                done.update(block.index)
+            print(f'Checkpoint {self.__checkpoint.path}: {len(done)} days done, '
+                  f'{len(self.trading_days) - len(done)} days left')
+            if len(done) == len(self.trading_days):
+                return []
+
+        # 实现了矩阵计算的因子直接一次性计算，不需要进程池
+        if self.has_panel():
+            t0 = time.time()
+            block = self.generate_factor_panel(self.trading_days[0], self.trading_days[-1])
+            block.index = pd.to_datetime(block.index).strftime('%Y-%m-%d')
+            # 矩阵计算时非NaN的格子视为计算过
+            self.collect_block((block.reindex(self.trading_days), None))
+            print(f' >>> {self.trading_days[0]} ~ {self.trading_days[-1]} {self.__factor_name} '
+                  f'panel calculation finished, Total Time = {round(time.time() - t0, 2)}s')
+            return []
+
+        if block_size is None:
+            block_size = auto_block_size(len(self.trading_days) - len(done), process)
+        return split_blocks(self.trading_days, block_size, skip=done)
+
+    def collect_block(self, result) -> None:
+        """
+        进程池回调函数：把一个交易日块的结果写入结果矩阵，并储存断点
+
+        :param result: get_block_result的结果(block, computed)，见FactorMatrix.write
+        """
+        block, computed = result
+        self.__factor.write(block, computed)
+        if self.__checkpoint is not None:
+            self.__checkpoint.dump(block, computed)
+
+    def __collect_error(self, block, e) -> None:
+        # 记录计算失败的交易日
+        self.__failed.extend(block)
+        print(f'Multi-Process Error: {block[0]} ~ {block[-1]}', e)
+
+    def submit_blocks(self, pool, blocks, share_mode, executor='process') -> None:
+        """
+        把交易日块发送给进程池计算，结果通过collect_block写入结果矩阵
+
+        :param pool: 进程池，由parallel_utils.create_pool创建
+        :param blocks: start_calculation返回的交易日块
+        :param share_mode: 创建进程池时使用的数据共享方式
+        :param executor: 创建池时使用的执行方式
+        """
+        if len(blocks) == 0:
+            return
+        if executor == 'process':
+            # pickle方式下测量需要序列化整个因子对象，只在fork/shm方式下输出，需要时可单独调用measure_ipc()
+            ipc = '' if share_mode == 'pickle' else f', IPC per task = {self.measure_ipc(blocks[0], share_mode)} bytes'
+            print(f'{self.__factor_name}: Share mode = {share_mode}, Block size = {len(blocks[0])}, '
+                  f'Tasks = {len(blocks)}{ipc}')
+        else:
+            print(f'{self.__factor_name}: Executor = {executor}, Block size = {len(blocks[0])}, Tasks = {len(blocks)}')
+
+        for block in blocks:
+            # 线程和串行直接调用，不需要pickle
+            if executor != 'process' or share_mode == 'pickle':
+                func, args = self.get_block_result, (block,)
+            else:
+                func, args = run_factor_task, (self.__factor_name, 'get_block_result', block)
+            pool.apply_async(
+                func=func,
+                args=args,
+                callback=self.collect_block,
+                error_callback=lambda e, b=block: self.__collect_error(b, e)
+            )
+
+    def finish_calculation(self) -> None:
+        """
+        进程池计算结束后调用，提示计算失败的交易日
+        """
+        if self.__failed:
+            print(f'Warning: {len(self.__failed)} days of {self.__factor_name} failed'
+                  + (', rerun with the same checkpoint to retry them' if self.__checkpoint is not None else ''))
+
+    def __calculate(self, process=1, share_mode=None, block_size=None, checkpoint_path=None, executor=None) -> None:
+        """
+        多进程计算self.trading_days中每一天的因子，结果直接写入预分配的self.__factor矩阵
+        交易日按block_size切分为连续的块，每个块作为一个任务发送给worker
+
+        :param process: 进程数
+        :param share_mode: 数据共享方式，见generate_factor_all
+        :param block_size: 每个任务的交易日数，见generate_factor_all
+        :param checkpoint_path: 断点储存目录，见generate_factor_all
+        :param executor: 执行方式，见generate_factor_all
+        """
+        share_mode = resolve_share_mode(share_mode)
+        executor = resolve_executor(executor or self.executor)
+        blocks = self.start_calculation(process, block_size, checkpoint_path)
+        if blocks:
+            pool, resources = create_pool(process, share_mode, [self], executor)
+            try:
+                self.submit_blocks(pool, blocks, share_mode, executor)
+                pool.close()
+                pool.join()
+            finally:
+                release_pool([self], resources)
+        self.finish_calculation()
+
     def generate_factor_all(
             self,
             sdt: str,
             edt: str,
             process=1,
-            nan_policy='keep'
+            nan_policy='keep',
+            share_mode=None,
+            block_size=None,
+            window=None,
+            checkpoint_path=None,
+            executor=None
     ):
         """
         计算因子并录入数据库
 
-        :param process: 线程数，可以多线程加速计算
+        :param process: 进程数（线程数），可以多进程加速计算
         :param sdt: (str)起始时间, YYYY-MM-DD
         :param edt: (str)结束时间, YYYY-MM-DD
-        :param pickle_path:
-        :param if_pickle:
+        :param nan_policy: 'keep' or 'drop'，generate_factor返回的NaN（及inf）值储存为null或不储存，见clear_factor
+        :param share_mode: 向worker传递数据的方式：
+            * 'pickle': 每个任务pickle整个因子对象
+            * 'fork': worker通过fork继承数据，任务只传递交易日（支持fork的系统上默认使用）
+            * 'shm': 数据矩阵放入共享内存，worker零拷贝读取，任务只传递交易日
+        :param block_size: 每个任务计算的连续交易日数，默认根据交易日数和进程数自动确定
+        :param window: 分窗口回填的交易日数，默认不分窗口。设置后按窗口依次获取数据、计算、储存并释放内存，
+                       内存占用只与窗口长度有关，此时不需要再调用save()。某个窗口有计算失败的交易日时，
+                       该窗口储存后抛出RuntimeError，不再计算后面的窗口
+        :param checkpoint_path: 断点储存目录，默认不储存。设置后每个交易日块完成后立即储存在本地，
+                                中断后以相同的参数重新运行，只会计算缺失或失败的交易日，
+                                save()成功且没有计算失败的交易日时删除断点
+        :param executor: 执行方式，默认使用类属性self.executor：
+            * 'process': 多进程，数据传递方式由share_mode决定
+            * 'thread': 多线程，直接读取self.EOD等数据，不拷贝，适合numpy/scipy/BLAS等释放GIL的计算
+            * 'serial': 在当前进程中逐块计算，用于调试
+            多进程和多线程都会把每个worker的BLAS线程数限制为 CPU核数 // process
         :return: None
         """
+        if window is not None:
+            self.__backfill(sdt, edt, window, process, nan_policy, share_mode, block_size, checkpoint_path,
+                            executor)
+            return
 
         t0 = time.time()
         print('-' * 10 + f' Begin to fetch data ' + '-' * 10)
@@ -172,34 +582,50 @@ class BaseFactor(object):
         print('-' * 10 + ' Factor Calculation Begin ' + '-' * 10)
         t0 = time.time()
 
-        # 多线程计算
-        pool = Pool(process)
-        for trading_day in self.trading_days:
-            pool.apply_async(
-                func=self.get_daily_result,
-                args=(trading_day,),
-                callback=self.__factor.append,
-                error_callback=lambda x: print('Multi-Process Error: ', x)
-            )
-        pool.close()
-        pool.join()
-
-        # 清洗 & 储存
-        self.__factor = pd.concat(self.__factor)
-        self.__factor.rename(columns={0: self.__factor_name}, inplace=True)
-        self.__factor.sort_values('TRADE_DT', ascending=True, inplace=True)
-        self.__factor.index = list(range(len(self.__factor)))
+        # 多进程计算
+        self.__calculate(process, share_mode, block_size, checkpoint_path, executor)
+
+        # 清洗
         self.clear_factor(nan_policy=nan_policy)
         print('-' * 10 + f' Factor Calculation Done！Time = {round(time.time() - t0)}s ' + '-' * 10)
 
+    def __backfill(self, sdt, edt, window, process, nan_policy, share_mode, block_size, checkpoint_path,
+                   executor) -> None:
+        """
+        分窗口回填：把[sdt, edt]的交易日切分为长度为window的窗口，每个窗口单独prepare_data、计算并储存，
+        每个窗口的预热数据由prepare_data按lagTradeDays向前多取，储存后释放该窗口的数据再进入下一个窗口
+        """
+        windows = split_blocks(self.get_trading_days(sdt, edt), window)
+        # prepare_data之前已有的属性，窗口结束后其他属性都会被释放
+        base_attrs = set(vars(self))
+        for i, days in enumerate(windows):
+            print('-' * 10 + f' Window {i + 1}/{len(windows)}: {days[0]} ~ {days[-1]} ' + '-' * 10)
+            self.generate_factor_all(days[0], days[-1], process, nan_policy, share_mode, block_size,
+                                     checkpoint_path=checkpoint_path, executor=executor)
+            self.save()
+            # 有交易日计算失败时不再继续后面的窗口，避免回填的区间中间缺少数据
+            if self.__failed:
+                raise RuntimeError(f'{len(self.__failed)} days of {self.__factor_name} failed in window '
+                                   f'{days[0]} ~ {days[-1]}, rerun the backfill from {days[0]} to retry them')
+
+            for attr in set(vars(self)) - base_attrs:
+                delattr(self, attr)
+            self.__factor = None
+            gc.collect()
+
     def save(
             self,
             if_pickle=False,
-            pickle_path=None
+            pickle_path=None,
+            n_jobs=4,
+            batch_size=100000
     ) -> None:
         """
         储存因子进入数据库
         【注意】：只需要在因子首次计算时调用，后续更新请调用__update_factor()
+
+        :param n_jobs: 同时写入数据库的线程数，见creat_mongodb
+        :param batch_size: 每次写入的文档数，见creat_mongodb
         """
         if self.__factor is None or len(self.__factor) == 0:
             return
@@ -207,46 +633,93 @@ class BaseFactor(object):
         # 将数据储存在mongo中
         # 储存存储因子的collection名称
         print(f'Begin to save {self.__factor_name} in {self.__save_db}.{self.__factor_name}')
-        print(f'Range from {self.__factor["TRADE_DT"].iloc[0]} to {self.__factor["TRADE_DT"].iloc[-1]}')
+        print(f'Range from {self.__factor.trading_days[0]} to {self.__factor.trading_days[-1]}')
+        # 只在储存时转换一次长格式
+        factor = self.get_factor()
         collection = client[self.__save_db][self.__factor_name]
-        creat_mongodb(self.__factor, collection, 'S_INFO_WINDCODE', 'TRADE_DT')
+        if collection.estimated_document_count() == 0:
+            creat_mongodb(factor, collection, 'S_INFO_WINDCODE', 'TRADE_DT', batch_size=batch_size, n_jobs=n_jobs,
+                          unique=True, layout=self.__layout, date_format=self.__date_format)
+        else:
+            # collection已有数据（如上次储存中途失败后重新运行），按区间幂等写入
+            upsert_range(factor, collection, sdt=self.__factor.trading_days[0], edt=self.__factor.trading_days[-1],
+                         n_jobs=n_jobs, unique=True)
 
         # 如果需要储存为pkl
         if if_pickle:
             if pickle_path is None:
                 raise NotImplementedError('please enter a pkl saving path!')
-            self.__factor.to_pickle(os.path.join(pickle_path, self.__factor_name))
+            factor.to_pickle(os.path.join(pickle_path, self.__factor_name))
+
+        # 已经储存进数据库，删除断点；有计算失败的交易日时保留断点，用同样的断点重新运行只计算失败的交易日
+        if self.__checkpoint is not None and not self.__failed:
+            self.__checkpoint.clear()
+            self.__checkpoint = None
+        elif self.__failed:
+            print(f'Warning: {len(self.__failed)} days of {self.__factor_name} failed and were not saved'
+                  + (f', checkpoint {self.__checkpoint.path} kept' if self.__checkpoint is not None else ''))
 
         print('Saving finished!')
 
-    def update_factor(
-            self,
-            process=1
-    ) -> None:
+    def get_update_range(self, max_dates=None):
         """
-        因子更新自动化函数，调用函数前请确保正确初始化对应因子对象，正确输入因子参数与名称以便client能正确访问到因子数据库
-        :return:
+        比对因子数据库与行情数据库中最新的日期，确定需要更新的区间
+        因子的最新日期读取自collection的元数据，行情由外部程序写入，直接查询最新日期（见mongodb_utils.get_max_dates）
+
+        :param max_dates: get_max_dates的结果，批量更新时所有因子共用一次读取的结果，没有包含的collection单独读取
+        :return: (sdt, edt)，不需要更新时返回None
         """
         # check if update
         print('Checking for updating...')
-        newest_dt_factor = pd.to_datetime(
-            client[self.__save_db][self.__factor_name]
-                .find().sort([('TRADE_DT', -1)])
-                .limit(1)[0]['TRADE_DT']
-        ).strftime('%Y-%m-%d')
-        newest_dt_price = pd.to_datetime(
-            client['basic_data']['Daily_return_with_cap']
-                .find().sort([('TRADE_DT', -1)])
-                .limit(1)[0]['TRADE_DT']
-        ).strftime('%Y-%m-%d')
+        factor_collection = self.get_collection()
+        price_collection = client['basic_data']['Daily_return_with_cap']
+        max_dates = dict(max_dates or {})
+        missing = [c for c in [factor_collection, price_collection] if c.full_name not in max_dates]
+        if missing:
+            max_dates.update(get_max_dates(missing))
+        if max_dates[factor_collection.full_name] is None:
+            raise ValueError(f'{factor_collection.full_name} is empty, please run generate_factor_all and save first')
+        newest_dt_factor = max_dates[factor_collection.full_name].strftime('%Y-%m-%d')
+        newest_dt_price = max_dates[price_collection.full_name].strftime('%Y-%m-%d')
 
         if newest_dt_factor >= newest_dt_price:
             print('No need for updating!')
-            return
+            return None
+
+        # 进程内共用的交易日历可能是之前加载的，不包含新的交易日时重新加载
+        get_trade_date(check_update=self.__trade_date_update, newest_dt=newest_dt_price)
 
         # if need, cal update range
-        sdt = self.TD.offset(newest_dt_factor, 1)
-        edt = newest_dt_price
+        return self.TD.offset(newest_dt_factor, 1), newest_dt_price
+
+    def save_update(self) -> None:
+        """
+        把更新计算的因子写入数据库，更新区间内的数据被替换，重复运行不会产生重复的文档
+        """
+        if self.__factor is None or len(self.__factor) == 0:
+            return
+        upsert_range(self.get_factor(), client[self.__save_db][self.__factor_name],
+                     sdt=self.__factor.trading_days[0], edt=self.__factor.trading_days[-1], unique=True)
+
+    def update_factor(
+            self,
+            process=1,
+            share_mode=None,
+            block_size=None,
+            executor=None
+    ) -> None:
+        """
+        因子更新自动化函数，调用函数前请确保正确初始化对应因子对象，正确输入因子参数与名称以便client能正确访问到因子数据库
+        :param process: 进程数
+        :param share_mode: 向worker传递数据的方式，见generate_factor_all
+        :param block_size: 每个任务计算的连续交易日数，见generate_factor_all
+        :param executor: 执行方式，见generate_factor_all
+        :return:
+        """
+        update_range = self.get_update_range()
+        if update_range is None:
+            return
+        sdt, edt = update_range
         updating_range = self.get_trading_days(sdt, edt)
 
         print(
@@ -262,28 +735,14 @@ class BaseFactor(object):
         print('-' * 10 + f' Fetching finished, time = {round(time.time() - t0)}s ' + '-' * 10)
 
         self.trading_days = updating_range
-        self.__factor = []
 
-        # 多线程计算
-        pool = Pool(process)
-        for trading_day in self.trading_days:
-            pool.apply_async(
-                func=self.get_daily_result,
-                args=(trading_day,),
-                callback=self.__factor.append,
-                error_callback=lambda x: print('Multi-Process Error: ', x)
-            )
-        pool.close()
-        pool.join()
+        # 多进程计算
+        self.__calculate(process, share_mode, block_size, executor=executor)
 
         # 储存
-        self.__factor = pd.concat(self.__factor)
-        self.__factor.rename(columns={0: self.__factor_name}, inplace=True)
-        self.__factor.sort_values('TRADE_DT', ascending=True, inplace=True)
-        self.__factor.index = list(range(len(self.__factor)))
         self.clear_factor()
         print(f'updating calculation finished, time = {time.time() - t0}s')
-        client[self.__save_db][self.__factor_name].insert_many(to_json_from_pandas(self.__factor))
+        self.save_update()
         return
 
     def test_calculation(self, dt):
@@ -301,13 +760,10 @@ class BaseFactor(object):
         :param edt: YYYY-MM-DD
         :return:
         """
-        edt = self.TD.offset(edt, 1)
-
         print('-' * 10 + f'Delete {self.__factor_name} data from {self.__save_db}.{self.__factor_name}' + '-' * 10)
         print('-' * 10 + f'Range from {sdt} to {edt}' + '-' * 10)
-        client[self.__save_db][self.__factor_name].delete_many(
-            {"TRADE_DT": {'$gte': sdt, '$lte': edt}}
-        )
+        upsert_range(pd.DataFrame(columns=['S_INFO_WINDCODE', 'TRADE_DT']),
+                     client[self.__save_db][self.__factor_name], sdt=sdt, edt=edt)
         print('-' * 10 + 'Delete Complete' + '-' * 10)
 
         return
@@ -11,18 +11,16 @@ import time
 import pandas as pd
 import pymongo
 import numpy as np
-from scipy import stats
+import sys
 
 sys.path.append('/home/lzy01/FactorBase/Code')
 from mongodb_utils import *
-from Helper import TradeDate, BenchMark
+from Helper import TradeDate, BenchMark, get_benchmark
 from BaseFactor import BaseFactor
 from multiprocessing import Pool
 
-# 初始化数据库连接【NOTE：必须进行初始化，否则无法运行】
-client = pymongo.MongoClient(host='localhost', port=27017)
-# 初始化Benchmark辅助类
-BM = BenchMark(check_update=False)
+# 数据库连接，第一次使用时才建立
+client = LazyClient()
 
 
 class BayesBeta(BaseFactor):
@@ -50,20 +48,18 @@ class BayesBeta(BaseFactor):
         shifted_begin_date = self.TD.offset(sdt, -self.lagTradeDays)
 
         # 获取股票行情
-        self.EOD = fetch_data(start_date=shifted_begin_date,
-                              end_date=edt,
-                              collection=client['basic_data']['Daily_return_with_cap'],
-                              time_query_key='TRADE_DT',
-                              factor_ls=['TRADE_DT', 'S_INFO_WINDCODE', 'adj_pct_chg'])
-
-        # --- 为了计算方便，变为矩阵储存
-        self.EOD = self.EOD.iloc[:, 1:].set_index(['TRADE_DT', 'S_INFO_WINDCODE']).unstack()
-        self.dates = list(self.EOD.index)
-        self.codes = [x[1] for x in list(self.EOD.columns)]
-        self.EOD.columns = self.codes
+        # --- 按年读取并直接储存为矩阵，内存中不保留完整的长表
+        self.EOD = fetch_panel(start_date=shifted_begin_date,
+                               end_date=edt,
+                               collection=client['basic_data']['Daily_return_with_cap'],
+                               field='adj_pct_chg')
+        # 每一行的交易日序号，generate_factor中按序号截取窗口
+        self.ordinals = self.TD.ordinal(self.EOD.index)
+        self.codes = list(self.EOD.columns)
 
         # 获取指数Benchmark
-        self.BenchMark = BM(shifted_begin_date, edt, self.benchmark).set_index('TRADE_DT')
+        self.BenchMark = get_benchmark()(shifted_begin_date, edt, self.benchmark).set_index('TRADE_DT')
+        self.bm_ordinals = self.TD.ordinal(self.BenchMark.index)
 
         return
 
@@ -71,12 +67,15 @@ class BayesBeta(BaseFactor):
         """
         返回某一天因子的数值：shape = [1,n] where n is the num of tickers
         """
-        begin_day = pd.to_datetime(self.TD.offset(edt, -self.lagTradeDays))
-        edt = pd.to_datetime(edt)
+        # 延迟导入scipy，import因子模块时不加载
+        from scipy import stats
+
+        # 按交易日序号截取edt及之前lagTradeDays个交易日
+        rows = self.window_rows(self.ordinals, edt, self.lagTradeDays)
 
         # 获取当天的ticker以及这些股票过去n天的收益、benchmark过去n天的收益
-        EOD_edt = self.EOD.loc[begin_day:edt, :]
-        bm_edt = self.BenchMark.loc[begin_day:edt, :]
+        EOD_edt = self.EOD.iloc[rows, :]
+        bm_edt = self.BenchMark.iloc[self.window_rows(self.bm_ordinals, edt, self.lagTradeDays), :]
 
         # 筛选当天能计算的股票，要求数据量大于window的40%
         indicator = ~(
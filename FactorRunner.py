@@ -0,0 +1,141 @@
+# -*- coding:utf-8 -*-
+"""
+@author: lzy <liuzhy.20@pbcsf.tsinghua.edu.cn>
+@file: FactorRunner.py
+@time:2022/01/10
+多因子运行模块：多个因子共用一个进程池和一份原始数据，用于每日批量更新和批量回填。
+"""
+import time
+import sys
+
+sys.path.append('/home/lzy01/FactorBase/Code')
+from mongodb_utils import *
+from parallel_utils import *
+
+# 数据库连接，第一次使用时才建立
+client = LazyClient()
+
+
+class FactorRunner(object):
+    __doc__ = """
+    多因子运行类，集成了：
+        * 所有因子的prepare_data在fetch_cache()中运行，同一collection、同一组字段的原始数据只读取一次
+        * 所有因子准备好数据后只启动一个进程池（或线程池），所有因子的交易日块都发送到这个池中计算
+        * 批量回填（generate_factor_all）和批量更新（update_factor）
+    【注意】：所有因子准备好的数据会同时保存在内存中
+    """
+
+    def __init__(
+            self,
+            factors: list,
+            process=1,
+            share_mode=None,
+            executor='process'
+    ) -> None:
+        """
+        :param factors: (list)BaseFactor子类的实例，因子名必须唯一
+        :param process: 进程数
+        :param share_mode: 向worker传递数据的方式，见BaseFactor.generate_factor_all
+        :param executor: 执行方式，'process', 'thread' or 'serial'，见BaseFactor.generate_factor_all
+        """
+        names = [factor.get_factor_name() for factor in factors]
+        if len(set(names)) != len(names):
+            raise ValueError(f'factor names must be unique: {names}')
+
+        # 按lagTradeDays从大到小排列，先读取的数据区间可以覆盖后面因子的请求
+        self.factors = sorted(factors, key=lambda x: -getattr(x, 'lagTradeDays', 0))
+        self.process = process
+        self.share_mode = resolve_share_mode(share_mode)
+        self.executor = resolve_executor(executor)
+        return
+
+    def __prepare(self, ranges: list) -> None:
+        """
+        依次运行每个因子的prepare_data，原始数据在因子之间共享
+
+        :param ranges: [(factor, sdt, edt)]
+        """
+        t0 = time.time()
+        print('-' * 10 + f' Begin to fetch data for {len(ranges)} factors ' + '-' * 10)
+        with fetch_cache():
+            for factor, sdt, edt in ranges:
+                factor.prepare_data(sdt, edt)
+                factor.trading_days = factor.get_trading_days(sdt, edt)
+        print('-' * 10 + f' Fetching finished, time = {round(time.time() - t0)}s ' + '-' * 10)
+
+    def __calculate(self, factors: list, block_size=None, checkpoint_path=None) -> None:
+        """
+        所有因子共用一个进程池计算
+        """
+        t0 = time.time()
+        print('-' * 10 + ' Factor Calculation Begin ' + '-' * 10)
+        tasks = [(factor, factor.start_calculation(self.process, block_size, checkpoint_path))
+                 for factor in factors]
+        pending = [factor for factor, blocks in tasks if blocks]
+
+        if pending:
+            pool, resources = create_pool(self.process, self.share_mode, pending, self.executor)
+            try:
+                for factor, blocks in tasks:
+                    factor.submit_blocks(pool, blocks, self.share_mode, self.executor)
+                pool.close()
+                pool.join()
+            finally:
+                release_pool(pending, resources)
+
+        for factor in factors:
+            factor.finish_calculation()
+        print('-' * 10 + f' Factor Calculation Done！Time = {round(time.time() - t0)}s ' + '-' * 10)
+
+    def generate_factor_all(
+            self,
+            sdt: str,
+            edt: str,
+            nan_policy='keep',
+            block_size=None,
+            checkpoint_path=None,
+            save=True
+    ) -> None:
+        """
+        批量计算所有因子并录入数据库
+
+        :param sdt: (str)起始时间, YYYY-MM-DD
+        :param edt: (str)结束时间, YYYY-MM-DD
+        :param nan_policy: 'keep' or 'drop'，generate_factor返回的NaN（及inf）值储存为null或不储存，见clear_factor
+        :param block_size: 每个任务计算的连续交易日数，见BaseFactor.generate_factor_all
+        :param checkpoint_path: 断点储存目录，见BaseFactor.generate_factor_all
+        :param save: 计算完成后是否调用每个因子的save()
+        """
+        self.__prepare([(factor, sdt, edt) for factor in self.factors])
+        self.__calculate(self.factors, block_size, checkpoint_path)
+
+        for factor in self.factors:
+            factor.clear_factor(nan_policy=nan_policy)
+            if save:
+                factor.save()
+
+    def update_factor(self, block_size=None) -> None:
+        """
+        批量更新所有因子，每个因子的更新区间由BaseFactor.get_update_range()确定
+
+        :param block_size: 每个任务计算的连续交易日数，见BaseFactor.generate_factor_all
+        """
+        # 所有因子的最新日期一次从元数据中读取，行情的最新日期只查询一次，所有因子共用
+        max_dates = get_max_dates([factor.get_collection() for factor in self.factors]
+                                  + [client['basic_data']['Daily_return_with_cap']])
+        ranges = []
+        for factor in self.factors:
+            update_range = factor.get_update_range(max_dates)
+            if update_range is not None:
+                ranges.append((factor, update_range[0], update_range[1]))
+        if len(ranges) == 0:
+            print('No need for updating!')
+            return
+
+        self.__prepare(ranges)
+        factors = [factor for factor, _, _ in ranges]
+        self.__calculate(factors, block_size)
+
+        for factor in factors:
+            factor.clear_factor()
+            factor.save_update()
@@ -3,19 +3,28 @@
 @author: lzy <liuzhy.20@pbcsf.tsinghua.edu.cn>
 @file: Helper.py
 @time:2021/11/27
-Helper：因子平台的辅助库：1）交易日辅助模块，2）Benchmark辅助模块
+Helper：因子平台的辅助库：1）交易日辅助模块，2）Benchmark辅助模块，3）断点续算模块
 """
 
-import pickle
+import datetime
+import hashlib
+import json
 import numpy as np
 import pandas as pd
 import os
 import sys
-import tushare as ts
-import pymongo
+import subprocess
 sys.path.append('/home/lzy01/FactorBase/Code')
 from mongodb_utils import *
-client = pymongo.MongoClient(host='localhost', port=27017)
+# 数据库连接，第一次使用时才建立
+client = LazyClient()
+
+# 交易日历的本地缓存文件，数据库中最新的交易日变化时才重新读取
+CALENDAR_CACHE = os.path.join(os.path.expanduser('~'), '.FactorBase', 'Trade_Dates.npy')
+
+# 进程内共用的交易日模块和benchmark模块，见get_trade_date()和get_benchmark()
+_TRADE_DATE = None
+_BENCHMARK = None
 
 
 class TradeDate(object):
@@ -25,37 +34,160 @@ class TradeDate(object):
         * 自动更新交易日数据库
         * 筛选查找交易日区间
         * 移动交易日
-        * 生成月末（初），季度末（初），年末（初）交易日的功能
+        * 生成周末（初），月末（初），季度末（初），年末（初）交易日的功能
     """
 
     def __init__(
             self,
             sdt='2000-01-01',
-            check_update=True
+            check_update=True,
+            cache_path=CALENDAR_CACHE
     ):
-
+        """
+        :param sdt: 交易日历的起始日期
+        :param check_update: 是否检查并更新交易日数据库
+        :param cache_path: 交易日历的本地缓存文件，None表示不使用缓存
+        """
         # 取出目前储存的数据，比对确定是否需要更新
+        self.checked = check_update
         if check_update:
             self.__update_dts()
         # 取出最新的trade date
-        self.trade_dates = pd.DataFrame.from_records(
-                client['basic_data']['Trade_Dates'].find(
-                {'TRADE_DT': {"$gte": sdt}})
-        ).sort_values('TRADE_DT')
-        self.trade_dates['TRADE_DT'] = pd.to_datetime(self.trade_dates['TRADE_DT'])
-        self.dates = sorted(self.trade_dates['TRADE_DT'].tolist())
+        values = self.__load_dts(cache_path)
+        values = values[values >= self._to_datetime64(sdt)]
+        self.__build_index(values)
+
+        dates = pd.DatetimeIndex(self.values)
+        self.trade_dates = pd.DataFrame({'TRADE_DT': dates, 'month': dates.month,
+                                         'year': dates.year, 'quarter': dates.quarter})
         print('-' * 5 + ' TradeDate Initializing Finished ' + '-' * 5)
         return
 
+    @staticmethod
+    def __load_dts(cache_path=None) -> np.ndarray:
+        """
+        读取全部交易日：本地缓存中最后一个交易日与数据库一致时直接使用缓存，
+        否则只从数据库读取去重后的TRADE_DT字段并重写缓存
+        :param cache_path: 本地缓存文件，None表示不使用缓存
+        :return: 排序后的datetime64数组
+        """
+        collection = client['basic_data']['Trade_Dates']
+        newest_dt = get_max_date(collection)
+
+        if cache_path is not None and os.path.exists(cache_path) and newest_dt is not None:
+            values = np.load(cache_path)
+            if len(values) and values[-1] == newest_dt.to_datetime64():
+                return values
+
+        values = np.sort(decode_dates(collection.distinct('TRADE_DT')))
+        if cache_path is not None:
+            # 先写临时文件再重命名，多个进程同时写入时不会读到不完整的文件
+            os.makedirs(os.path.dirname(os.path.abspath(cache_path)), exist_ok=True)
+            tmp = f'{cache_path}.{os.getpid()}.tmp'
+            with open(tmp, 'wb') as f:
+                np.save(f, values)
+            os.replace(tmp, cache_path)
+        return values
+
+    def __build_index(self, values: np.ndarray) -> None:
+        """
+        建立交易日索引：
+            * values：排序后的datetime64数组，用于二分查找
+            * __date_set：交易日的int64哈希集合，用于判断是否为交易日
+            * __labels：'YYYY-MM-DD'格式的交易日，按位置直接切片输出
+            * __ordinals：'YYYY-MM-DD' -> 交易日序号（即在values中的位置），交易日字符串无需解析
+            * __period_starts / __period_ends：每周（月、季、年）第一个和最后一个交易日的序号
+        """
+        self.values = np.unique(values.astype('datetime64[ns]'))
+        self.dates = list(pd.DatetimeIndex(self.values))
+        self.__date_set = set(self.values.view('i8').tolist())
+        self.__labels = np.array(pd.DatetimeIndex(self.values).strftime('%Y-%m-%d'), dtype=object)
+        self.__ordinals = dict(zip(self.__labels, range(len(self.__labels))))
+
+        self.__period_starts, self.__period_ends = {}, {}
+        for freq, key in self._period_keys(self.values).items():
+            change = np.flatnonzero(key[1:] != key[:-1])
+            self.__period_starts[freq] = np.concatenate([[0], change + 1]) if len(key) else change
+            self.__period_ends[freq] = np.concatenate([change, [len(key) - 1]]) if len(key) else change
+
+    @staticmethod
+    def _period_keys(values: np.ndarray) -> dict:
+        """
+        每个交易日所在周（w）、月（m）、季（q）、年（y）的整数编号，不同年份的同一月份编号不同
+        """
+        days = values.astype('datetime64[D]').astype(np.int64)
+        months = values.astype('datetime64[M]').astype(np.int64)
+        return {
+            # 1970-01-01是周四，加3之后按周一分周
+            'w': (days + 3) // 7,
+            'm': months,
+            'q': months // 3,
+            'y': values.astype('datetime64[Y]').astype(np.int64),
+        }
+
+    @staticmethod
+    def _to_datetime64(tday) -> np.datetime64:
+        """
+        把输入日期（'YYYY-MM-DD'，datetime或Timestamp）转换为datetime64[ns]
+        """
+        if not isinstance(tday, (datetime.datetime, datetime.date, np.datetime64)):
+            tday = str(tday)
+        return pd.Timestamp(tday).to_datetime64().astype('datetime64[ns]')
+
+    def __len__(self) -> int:
+        return len(self.values)
+
+    def position(self, tday) -> int:
+        """
+        给定日期之前（含当天）最后一个交易日的位置，O(log n)
+        :param tday: 目标日期，可以不是交易日
+        :return: 在交易日数组中的位置，早于第一个交易日时返回-1
+        """
+        if isinstance(tday, str) and tday in self.__ordinals:
+            return self.__ordinals[tday]
+        return int(np.searchsorted(self.values, self._to_datetime64(tday), side='right')) - 1
+
+    def ordinal(self, tdays) -> np.ndarray:
+        """
+        批量把日期映射为交易日序号，非交易日映射为之前（含当天）最后一个交易日的序号。
+        同一进程内序号固定，可以代替日期作为数据矩阵的行标签，窗口[i-L, i]只需整数比较
+        :param tdays: 日期列表或DatetimeIndex
+        :return: int64数组，早于第一个交易日的日期为-1
+        """
+        values = pd.DatetimeIndex(pd.to_datetime(list(tdays))).values.astype('datetime64[ns]')
+        return np.searchsorted(self.values, values, side='right').astype(np.int64) - 1
+
+    def locate(self, sdt, edt) -> slice:
+        """
+        给定开始日期和结束日期（闭区间）内的交易日在交易日数组中的位置区间
+        :param sdt: 开始日期，可以不是交易日
+        :param edt: 结束日期，可以不是交易日
+        :return: slice(start, stop)，左闭右开
+        """
+        start = int(np.searchsorted(self.values, self._to_datetime64(sdt), side='left'))
+        stop = int(np.searchsorted(self.values, self._to_datetime64(edt), side='right'))
+        return slice(start, max(start, stop))
+
+    def range_pos(self, start: int, stop: int) -> list:
+        """
+        按位置取出交易日，左闭右开
+        :param start: 开始位置
+        :param stop: 结束位置
+        :return: list of 'YYYY-MM-DD'
+        """
+        return self.__labels[start:stop].tolist()
+
     def __update_dts(self) -> None:
         """
         自动更新交易日数据库
         :return:
         """
         # 分别取出日期数据库和交易数据库中最新的日期进行比对：
-        newest_dt = client['basic_data']['Trade_Dates'].find().sort([('TRADE_DT', -1)]).limit(1)[0]['TRADE_DT']
-        newest_dt_price = client['basic_data']['Daily_return_with_cap'] \
-            .find().sort([('TRADE_DT', -1)]).limit(1)[0]['TRADE_DT']
+        # 两个collection的日期储存格式可以不同，统一转换为Timestamp比较
+        price = client['basic_data']['Daily_return_with_cap']
+        max_dates = get_max_dates([client['basic_data']['Trade_Dates'], price])
+        newest_dt = max_dates[client['basic_data']['Trade_Dates'].full_name]
+        newest_dt_price = max_dates[price.full_name]
 
         if newest_dt >= newest_dt_price:
             print('No need for updating')
@@ -63,24 +195,20 @@ class TradeDate(object):
         else:
             print('-' * 10 + ' Start Updating Trading Dates ' + '-' * 10)
 
+            # 只取出日期数据库最后一天之后的去重日期，不读取行情数据
             update_data = pd.DataFrame(
-
-                pd.DataFrame.from_records(
-                        client['basic_data']['Daily_return_with_cap'].find(
-                        {'TRADE_DT': {"$gte": newest_dt}})
-                )['TRADE_DT'].unique(),
-
+                np.sort(decode_dates(price.distinct(
+                    'TRADE_DT', {'TRADE_DT': {"$gt": encode_date(newest_dt, get_date_format(price))}}))),
                 columns=['TRADE_DT']
             )
 
-            update_data = update_data.iloc[1:, :]  # 由于取出的是大于等于日期数据库最后一天的数据，所以必须在添加时候把这一日期删除
-            update_data['TRADE_DT'] = update_data['TRADE_DT'].apply(lambda x: pd.to_datetime(x))
             update_data['month'] = update_data['TRADE_DT'].apply(lambda x: x.month)
             update_data['year'] = update_data['TRADE_DT'].apply(lambda x: x.year)
             update_data['quarter'] = update_data['month'].apply(lambda x: self._get_quarter(x))
 
-            insert_data = to_json_from_pandas(update_data[['TRADE_DT', 'month', 'year', 'quarter']])
-            client['basic_data']['Trade_Dates'].insert_many(insert_data)
+            # 按Trade_Dates中已有的日期格式写入
+            upsert_range(update_data[['TRADE_DT', 'month', 'year', 'quarter']], client['basic_data']['Trade_Dates'],
+                         id_index=None)
 
             print('-' * 10 + ' Updating Complete ' + '-' * 10)
             return
@@ -94,11 +222,7 @@ class TradeDate(object):
         :param tday:
         :return:
         """
-        if isinstance(tday, pd.datetime):
-            tday = pd.to_datetime(tday)
-        else:
-            tday = pd.to_datetime(str(tday))
-        return tday in self.dates
+        return int(self._to_datetime64(tday).view('i8')) in self.__date_set
 
     def offset(
             self,
@@ -112,16 +236,26 @@ class TradeDate(object):
         :param n:挪动幅度
         :return:挪动后的日期
         """
-        if isinstance(tday, pd.datetime):
-            tday = pd.to_datetime(tday)
-        else:
-            tday = pd.to_datetime(str(tday))
+        k = self.position(tday)
+        if k < 0:
+            raise ValueError(f'{tday} is earlier than the first trade date')
+        return self.__labels[max(k + n, 0)]
 
-        lstday = max([i for i in self.dates if i <= tday])
-        k = self.dates.index(lstday)
-        tdayinx = k + n
-        tdayinx = max(tdayinx, 0)
-        return self.dates[tdayinx].strftime('%Y-%m-%d')
+    def offset_many(
+            self,
+            tdays,
+            n
+    ) -> list:
+        """
+        offset的向量化版本，一次挪动多个日期
+        :param tdays: 目标日期列表，可以不是交易日
+        :param n: 挪动幅度
+        :return: 挪动后的日期列表
+        """
+        k = self.ordinal(tdays)
+        if len(k) and k.min() < 0:
+            raise ValueError('some dates are earlier than the first trade date')
+        return self.__labels[np.maximum(k + n, 0)].tolist()
 
     def range(self, sdt, edt) -> list:
         """
@@ -130,12 +264,8 @@ class TradeDate(object):
         :param edt:结束日期 'YYYY-MM-DD'
         :return:
         """
-        dates = self.trade_dates[
-            (self.trade_dates['TRADE_DT'] >= pd.to_datetime(sdt))
-            &
-            (self.trade_dates['TRADE_DT'] <= pd.to_datetime(edt))]
-
-        return [x.strftime('%Y-%m-%d') for x in dates['TRADE_DT'].to_list()]
+        pos = self.locate(sdt, edt)
+        return self.range_pos(pos.start, pos.stop)
 
     def range_with_freq(
             self,
@@ -145,23 +275,29 @@ class TradeDate(object):
             is_start=False,
     ) -> list:
         """
-        取出sdt到edt之间所有月（m）或季（q）或年（y）的最后（开始）一天，以列表形式返回
+        取出sdt到edt之间所有周（w）或月（m）或季（q）或年（y）的最后（开始）一天，以列表形式返回
+        两端不完整的周期返回区间内的最后（开始）一个交易日
         :param sdt: 开始日期 'YYYY-MM-DD'，可以不是交易日
         :param edt: 结束日期 'YYYY-MM-DD'，可以不是交易日
-        :param freq: 频率，可以选择m，q，y （TODO：扩展到周频）
+        :param freq: 频率，可以选择w，m，q，y
         :param is_start: 是否返回第一天，默认为False，返回最后一天。
         :return:
         """
-        if freq not in ['m', 'q', 'y']:
-            raise NotImplementedError('please enter the right fre: "m", "q", "y".')
-        freq_dict = {"m": 'month', "q": 'quarter', "y": 'year'}
-
-        trade_dates = self.trade_dates[(self.trade_dates['TRADE_DT'] >= pd.to_datetime(sdt)) &
-                                       (self.trade_dates['TRADE_DT'] <= pd.to_datetime(edt))]
-        freq_dates = trade_dates.sort_values('TRADE_DT', ascending=is_start).groupby([freq_dict[freq]]).first()
-
-        return [x.strftime('%Y-%m-%d') for x in
-                freq_dates.sort_values(freq_dict[freq], ascending=True)['TRADE_DT'].tolist()]
+        if freq not in ['w', 'm', 'q', 'y']:
+            raise NotImplementedError('please enter the right fre: "w", "m", "q", "y".')
+
+        pos = self.locate(sdt, edt)
+        if pos.start == pos.stop:
+            return []
+
+        table = self.__period_starts[freq] if is_start else self.__period_ends[freq]
+        ords = table[np.searchsorted(table, pos.start, side='left'):np.searchsorted(table, pos.stop, side='left')]
+        # 区间两端截断的周期
+        if is_start and (len(ords) == 0 or ords[0] != pos.start):
+            ords = np.concatenate([[pos.start], ords])
+        if not is_start and (len(ords) == 0 or ords[-1] != pos.stop - 1):
+            ords = np.concatenate([ords, [pos.stop - 1]])
+        return self.__labels[ords].tolist()
 
     @staticmethod
     def _get_quarter(month):
@@ -186,6 +322,7 @@ class BenchMark(object):
         # 目前支持的index
         self.benchmark_names = {'000300.SH': 'hs300', '000905.SH': 'zz500'}
         # 取出目前储存的数据，比对确定是否需要更新
+        self.checked = check_update
         if check_update:
             self.__update_benchmark()
         print('-' * 5 + ' BenchMark Initializing Finished ' + '-' * 5)
@@ -200,15 +337,15 @@ class BenchMark(object):
     def __update_benchmark(self) -> None:
 
         # 分别取出日期数据库和交易数据库中最新的日期进行比对：
-        newest_dt = client['basic_data']['BenchMarks'].find().sort([('TRADE_DT', -1)]).limit(1)[0]['TRADE_DT']
-        newest_dt_price = client['basic_data']['Daily_return_with_cap'] \
-            .find().sort([('TRADE_DT', -1)]).limit(1)[0]['TRADE_DT']
+        max_dates = get_max_dates([client['basic_data']['BenchMarks'], client['basic_data']['Daily_return_with_cap']])
+        newest_dt = max_dates[client['basic_data']['BenchMarks'].full_name]
+        newest_dt_price = max_dates[client['basic_data']['Daily_return_with_cap'].full_name]
 
         if newest_dt >= newest_dt_price:
             print('No need for updating BenchMark')
             return
         else:
-            dts = TD.range(newest_dt, newest_dt_price)[1:]
+            dts = get_trade_date(newest_dt=newest_dt_price).range(newest_dt, newest_dt_price)[1:]
             sdt, edt = dts[0], dts[-1]
             print('-' * 10 + ' Start Updating BenchMarks ' + '-' * 10)
             print('-' * 10 + f' range from {sdt} to {edt}' + '-' * 10)
@@ -228,8 +365,8 @@ class BenchMark(object):
                 ts_index[0] = ts_index[0].merge(ts_index[i], on = ['TRADE_DT'], how = 'outer')
             insert_data = ts_index[0]
             self.insert = insert_data
-            insert_data = to_json_from_pandas(insert_data)
-            client['basic_data']['BenchMarks'].insert_many(insert_data)
+            # 按BenchMarks中已有的日期格式写入
+            upsert_range(insert_data, client['basic_data']['BenchMarks'], id_index=None)
             print('-' * 10 + ' Updating Complete ' + '-' * 10)
             return
 
@@ -244,6 +381,8 @@ class BenchMark(object):
         :param edt:
         :return:
         """
+        # 延迟导入tushare，只有更新benchmark时才需要
+        import tushare as ts
         ts.set_token('dfb6e9f4f9a3db86c59a3a0f680a9bdc46ed1b5adbf1e354c7faa761')
         pro = ts.pro_api()
 
@@ -257,12 +396,21 @@ class BenchMark(object):
 
     @staticmethod
     def get_fullMKT(sdt: str, edt: str) -> pd.DataFrame:
-        # fetch data
+        # fetch data：逐年读取计算，每天的市场收益只依赖当天的数据
         collection = client['basic_data']['Daily_return_with_cap']
-        ret_data = fetch_data(sdt, edt, collection,
-                              time_query_key='TRADE_DT',
-                              factor_ls=['TRADE_DT', 'adj_pct_chg', 'TOT_SHR', 'S_DQ_CLOSE'])\
-                   .dropna().iloc[:, 1:]
+        mkt = fetch_data_reduce(sdt, edt, collection,
+                                lambda result, chunk: result + [BenchMark._fullMKT(chunk.dropna())],
+                                initial=[],
+                                time_query_key='TRADE_DT',
+                                factor_ls=['TRADE_DT', 'adj_pct_chg', 'TOT_SHR', 'S_DQ_CLOSE'],
+                                freq='y',
+                                columnar=True)
+        if len(mkt) == 0:
+            return pd.DataFrame(columns=['TRADE_DT', 'full_market'])
+        return pd.concat(mkt, ignore_index=True)
+
+    @staticmethod
+    def _fullMKT(ret_data: pd.DataFrame) -> pd.DataFrame:
         # calculate VW MKT ret
         ret_data['cap'] = np.log(ret_data['TOT_SHR'] * ret_data['S_DQ_CLOSE'])
         cap = ret_data.groupby(['TRADE_DT'])[['cap']].sum().reset_index().rename(columns = {'cap': 'total_cap'})
@@ -274,3 +422,102 @@ class BenchMark(object):
               .rename(columns = {"ret_with_weight":'full_market'})
         return mkt
 
+
+def get_trade_date(check_update=False, newest_dt=None) -> TradeDate:
+    """
+    获取进程内共用的交易日模块，第一次调用时才从数据库加载
+    :param check_update: 是否检查并更新交易日数据库，同一进程中只会检查一次
+    :param newest_dt: 需要覆盖的最新日期（如行情的最新日期），共用的交易日历早于该日期时检查更新并重新加载，
+                      用于长时间运行的进程（定时任务、notebook）跨日更新因子
+    :return:
+    """
+    global _TRADE_DATE
+    stale = (_TRADE_DATE is not None and newest_dt is not None and len(_TRADE_DATE) != 0
+             and _TRADE_DATE.values[-1] < parse_date(newest_dt).to_datetime64())
+    if _TRADE_DATE is None or stale or (check_update and not _TRADE_DATE.checked):
+        _TRADE_DATE = TradeDate(check_update=check_update or stale)
+    return _TRADE_DATE
+
+
+def get_benchmark(check_update=False) -> BenchMark:
+    """
+    获取进程内共用的benchmark模块，第一次调用时才初始化
+    :param check_update: 是否检查并更新benchmark数据库，同一进程中只会检查一次
+    :return:
+    """
+    global _BENCHMARK
+    if _BENCHMARK is None or (check_update and not _BENCHMARK.checked):
+        _BENCHMARK = BenchMark(check_update=check_update)
+    return _BENCHMARK
+
+
+def import_cost(module: str) -> float:
+    """
+    在新的python进程中测量import一个模块的耗时（秒），不受当前进程中已经import的模块影响
+    :param module: 模块名，如'f00001_CH3RES'
+    :return:
+    """
+    code = f'import time; t0 = time.perf_counter(); import {module}; print(time.perf_counter() - t0)'
+    output = subprocess.run([sys.executable, '-c', code], check=True, capture_output=True, text=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__))).stdout
+    return float(output.strip().splitlines()[-1])
+
+
+class CheckPoint(object):
+
+    __doc__ = """
+    断点续算模块，用于长时间的因子回填：
+        * 每个计算完成的交易日块立即储存在本地目录中
+        * 目录由因子名、因子参数和计算区间唯一确定，参数或区间变化后不会误用旧的结果
+        * 重新运行时只需要计算缺失或失败的交易日，储存进数据库后调用clear()删除
+    """
+
+    def __init__(
+            self,
+            path: str,
+            factor_name: str,
+            factor_parameters: dict,
+            sdt: str,
+            edt: str
+    ) -> None:
+        """
+        :param path: 本地储存目录
+        :param factor_name: 因子名
+        :param factor_parameters: 因子参数
+        :param sdt: 计算起始日 YYYY-MM-DD
+        :param edt: 计算结束日 YYYY-MM-DD
+        """
+        key = json.dumps([factor_name, factor_parameters, sdt, edt], sort_keys=True, default=str)
+        self.path = os.path.join(path, f'{factor_name}_{hashlib.md5(key.encode()).hexdigest()[:12]}')
+        os.makedirs(self.path, exist_ok=True)
+        return
+
+    def dump(self, block: pd.DataFrame, computed=None) -> None:
+        """
+        储存一个交易日块的计算结果，先写临时文件再重命名，中途退出不会留下不完整的文件
+        :param block: 交易日 × ticker 的因子矩阵
+        :param computed: 计算过的格子，见FactorMatrix.write
+        """
+        name = f'{block.index[0]}_{block.index[-1]}_{len(block)}'
+        tmp = os.path.join(self.path, name + '.tmp')
+        pd.to_pickle((block, computed), tmp)
+        os.replace(tmp, os.path.join(self.path, name + '.pkl'))
+
+    def load(self) -> list:
+        """
+        读取已经储存的所有交易日块
+        :return: list of (block, computed)
+        """
+        out = []
+        for f in sorted(os.listdir(self.path)):
+            if f.endswith('.pkl'):
+                out.append(pd.read_pickle(os.path.join(self.path, f)))
+        return out
+
+    def clear(self) -> None:
+        """
+        结果储存进数据库后删除断点
+        """
+        for f in os.listdir(self.path):
+            os.remove(os.path.join(self.path, f))
+        os.rmdir(self.path)
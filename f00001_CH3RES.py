@@ -9,7 +9,7 @@ import time
 import pandas as pd
 import pymongo
 import numpy as np
-import statsmodels.api as sm
+import sys
 
 sys.path.append('/home/public/因子平台/BaseFiles')
 from mongodb_utils import *
@@ -17,8 +17,8 @@ from Helper import TradeDate, BenchMark
 from BaseFactor import BaseFactor
 from multiprocessing import Pool
 
-# 初始化数据库连接【NOTE：必须进行初始化，否则无法运行】
-client = pymongo.MongoClient(host='localhost', port=27017)
+# 数据库连接，第一次使用时才建立
+client = LazyClient()
 
 
 class CH3RES(BaseFactor):
@@ -46,25 +46,24 @@ class CH3RES(BaseFactor):
         shifted_begin_date = self.TD.offset(sdt, -self.lagTradeDays)
 
         # 获取股票行情
-        self.EOD = fetch_data(start_date=shifted_begin_date,
-                              end_date=edt,
-                              collection=client['basic_data']['Daily_return_with_cap'],
-                              time_query_key='TRADE_DT',
-                              factor_ls=['TRADE_DT', 'S_INFO_WINDCODE', 'adj_pct_chg'])
-
-        # --- 为了计算方便，变为矩阵储存
-        self.EOD = self.EOD.iloc[:, 1:].set_index(['TRADE_DT', 'S_INFO_WINDCODE']).unstack()
-        self.dates = list(self.EOD.index)
-        self.codes = [x[1] for x in list(self.EOD.columns)]
-        self.EOD.columns = self.codes
+        # --- 按年读取并直接储存为矩阵，内存中不保留完整的长表
+        self.EOD = fetch_panel(start_date=shifted_begin_date,
+                               end_date=edt,
+                               collection=client['basic_data']['Daily_return_with_cap'],
+                               field='adj_pct_chg')
+        # 每一行的交易日序号，generate_factor中按序号截取窗口
+        self.ordinals = self.TD.ordinal(self.EOD.index)
+        self.codes = list(self.EOD.columns)
 
         # --- 获取CH3因子收益
         self.CH3 = fetch_data(start_date=shifted_begin_date,
                               end_date=edt,
                               collection=client['basic_data']['CH3_Daily'],
                               time_query_key='TRADE_DT',
-                              factor_ls=['TRADE_DT', 'mktrf', 'smb', 'vmg'])
+                              factor_ls=['TRADE_DT', 'mktrf', 'smb', 'vmg'],
+                              columnar=True)
         self.CH3 = self.CH3.set_index('TRADE_DT').sort_index(ascending=True)
+        self.ch3_ordinals = self.TD.ordinal(self.CH3.index)
 
         return
 
@@ -72,12 +71,15 @@ class CH3RES(BaseFactor):
         """
         返回某一天因子的数值：shape = [1,n] where n is the num of tickers
         """
-        begin_day = pd.to_datetime(self.TD.offset(edt, -self.lagTradeDays))
-        edt = pd.to_datetime(edt)
+        # 延迟导入statsmodels，import因子模块时不加载
+        import statsmodels.api as sm
+
+        # 按交易日序号截取edt及之前lagTradeDays个交易日
+        rows = self.window_rows(self.ordinals, edt, self.lagTradeDays)
 
         # 获取当天的ticker以及这些股票过去n天的收益、benchmark过去n天的收益
-        EOD_edt = self.EOD.loc[begin_day:edt, :]
-        ch3_edt = self.CH3.loc[begin_day:edt, :]
+        EOD_edt = self.EOD.iloc[rows, :]
+        ch3_edt = self.CH3.iloc[self.window_rows(self.ch3_ordinals, edt, self.lagTradeDays), :]
 
         # 筛选当天能计算的股票，要求数据量大于window的40%
         indicator = ~(
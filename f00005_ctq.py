@@ -9,7 +9,7 @@ import time
 import pandas as pd
 import pymongo
 import numpy as np
-import statsmodels.api as sm
+import sys
 
 sys.path.append('/home/public/因子平台/BaseFiles')
 from mongodb_utils import *
@@ -17,8 +17,8 @@ from Helper import TradeDate, BenchMark
 from BaseFactor import BaseFactor
 from multiprocessing import Pool
 
-# 初始化数据库连接【NOTE：必须进行初始化，否则无法运行】
-client = pymongo.MongoClient(host='localhost', port=27017)
+# 数据库连接，第一次使用时才建立
+client = LazyClient()
 
 
 class CTQ(BaseFactor):
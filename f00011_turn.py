@@ -9,7 +9,7 @@ import time
 import pandas as pd
 import pymongo
 import numpy as np
-import statsmodels.api as sm
+import sys
 
 sys.path.append('/home/public/因子平台/BaseFiles')
 from mongodb_utils import *
@@ -17,8 +17,8 @@ from Helper import TradeDate, BenchMark
 from BaseFactor import BaseFactor
 from multiprocessing import Pool
 
-# 初始化数据库连接【NOTE：必须进行初始化，否则无法运行】
-client = pymongo.MongoClient(host='localhost', port=27017)
+# 数据库连接，第一次使用时才建立
+client = LazyClient()
 
 
 class TURN(BaseFactor):
@@ -44,21 +44,17 @@ class TURN(BaseFactor):
         # 多取一些数据做填充
         shifted_begin_date = self.TD.offset(sdt, -self.lagTradeDays)
 
-        # 获取股票行情
-        self.EOD = fetch_data(start_date=shifted_begin_date,
-                              end_date=edt,
-                              collection=client['basic_data']['Daily_return_with_cap'],
-                              time_query_key='TRADE_DT',
-                              factor_ls=['TRADE_DT', 'S_INFO_WINDCODE', 'S_DQ_VOLUME', 'FLOAT_SHARE'])
-        
-
-        # --- 为了计算方便，变为矩阵储存
-        vol = self.EOD[['TRADE_DT', 'S_INFO_WINDCODE', 'S_DQ_VOLUME']].set_index(['TRADE_DT', 'S_INFO_WINDCODE']).unstack()
-        float_shr = self.EOD[['TRADE_DT', 'S_INFO_WINDCODE', 'FLOAT_SHARE']].set_index(['TRADE_DT', 'S_INFO_WINDCODE']).unstack()
-        self.turnovr = vol / float_shr
-        self.dates = list(self.EOD.index)
-        self.codes = [x[1] for x in list(self.EOD.columns)]
-        self.EOD.columns = self.codes
+        # 获取股票行情：成交量和流通股本一次读取，直接储存为矩阵
+        panels = fetch_panel(start_date=shifted_begin_date,
+                             end_date=edt,
+                             collection=client['basic_data']['Daily_return_with_cap'],
+                             field=['S_DQ_VOLUME', 'FLOAT_SHARE'])
+
+        # --- 换手率矩阵，两个矩阵的行列相同
+        self.turnovr = panels['S_DQ_VOLUME'] / panels['FLOAT_SHARE']
+        # 每一行的交易日序号，generate_factor中按序号截取窗口
+        self.ordinals = self.TD.ordinal(self.turnovr.index)
+        self.codes = list(self.turnovr.columns)
 
         return
 
@@ -66,21 +62,21 @@ class TURN(BaseFactor):
         """
         返回某一天因子的数值：shape = [1,n] where n is the num of tickers
         """
-        begin_day = pd.to_datetime(self.TD.offset(edt, -self.lagTradeDays))
-        edt = pd.to_datetime(edt)
+        # 按交易日序号截取edt及之前lagTradeDays个交易日
+        rows = self.window_rows(self.ordinals, edt, self.lagTradeDays)
 
         # 获取当天的ticker以及这些股票过去n天的收益、benchmark过去n天的收益
-        EOD_edt = self.turnovr.loc[begin_day:edt, :]
+        EOD_edt = self.turnovr.values[rows]
 
         # 筛选当天能计算的股票，要求数据量大于window的40%
         # TODO IPO days
         indicator = ~(
-                (np.isnan(EOD_edt.iloc[-1, :])) |
-                (np.nansum(np.isnan(EOD_edt), axis=0) >= int(self.lagTradeDays * 0.4))
+                np.isnan(EOD_edt[-1, :]) |
+                (np.isnan(EOD_edt).sum(axis=0) >= int(self.lagTradeDays * 0.4))
         ) 
 
-        EOD_edt = (EOD_edt.T[indicator.values]).T
-        codes = list(EOD_edt.columns)
+        EOD_edt = EOD_edt[:, indicator]
+        codes = list(self.turnovr.columns[indicator])
 
         # 开始计算
         mean_turn = np.nanmean(EOD_edt, axis=0)
@@ -88,6 +84,20 @@ class TURN(BaseFactor):
 
         return out
 
+    def generate_factor_panel(self, sdt, edt):
+        """
+        一次性计算sdt到edt所有交易日的因子：shape = [d,n] where d is the num of trading days
+        """
+        window = self.lagTradeDays + 1
+
+        # 筛选每天能计算的股票，要求数据量大于window的40%
+        indicator = self.valid_window(self.turnovr, window, int(self.lagTradeDays * 0.4))
+
+        # 开始计算
+        out = self.rolling_mean(self.turnovr, window)
+
+        return out.where(indicator).loc[pd.to_datetime(sdt):pd.to_datetime(edt)]
+
 
 if __name__ == '__main__':
 
@@ -1,8 +1,373 @@
+import os
+import time
+import datetime
+import threading
+import numpy as np
 import pandas as pd
 import pymongo
 import json
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
 
+try:
+    from pymongoarrow.api import find_arrow_all
+except ImportError:
+    find_arrow_all = None
+
+# pandas 2.0之后to_datetime按第一个值推断格式，格式不同的字符串需要format='mixed'逐个推断，之前的版本默认逐个推断
+_MIXED_FORMAT = {'format': 'mixed'} if int(pd.__version__.split('.')[0]) >= 2 else {}
+
+# fetch_data的进程内缓存，None表示不缓存，见fetch_cache()
+_FETCH_CACHE = None
+
+# 按交易日分桶储存时，每个文档中标记储存格式的字段（见to_day_buckets），逐行储存的文档没有该字段
+LAYOUT_KEY = '_layout'
+
+# MongoClient的连接参数，可以用环境变量或configure_client()修改，见get_client()
+MONGO_CONFIG = {
+    'host': os.environ.get('FACTORBASE_MONGO_HOST', 'localhost'),
+    'port': int(os.environ.get('FACTORBASE_MONGO_PORT', 27017)),
+    # 连接池大小，需不小于同时读写数据库的线程数（fetch_data、creat_mongodb、upsert_range的n_jobs）
+    'maxPoolSize': int(os.environ.get('FACTORBASE_MONGO_POOL_SIZE', 100)),
+}
+
+# 每个database中记录各collection日期范围、文档数和最后写入时间的collection，见get_meta()
+META_COLLECTION = '_collection_meta'
+
+# 由外部程序写入（不经过record_write）的collection，元数据不可信，get_max_dates每次都直接查询最新日期
+EXTERNAL_COLLECTIONS = ['basic_data.Daily_return_with_cap']
+
+# 进程内共用的MongoClient，第一次使用时才创建，见get_client()
+_CLIENT = None
+# 创建_CLIENT的进程，fork出的子进程中不再使用父进程的client
+_CLIENT_PID = None
+_CLIENT_LOCK = threading.Lock()
+
+
+def get_client():
+    """
+    获取进程内共用的MongoClient，第一次调用时才创建：
+        * 同一进程的所有模块、所有线程共用一个client及其连接池
+        * MongoClient不是fork安全的，fork出的子进程（如进程池的worker）第一次使用时重新创建自己的client，
+          不会使用父进程的连接
+    """
+    global _CLIENT, _CLIENT_PID
+    if _CLIENT is None or _CLIENT_PID != os.getpid():
+        with _CLIENT_LOCK:
+            if _CLIENT is None or _CLIENT_PID != os.getpid():
+                _CLIENT = pymongo.MongoClient(connect=False, **MONGO_CONFIG)
+                _CLIENT_PID = os.getpid()
+    return _CLIENT
+
+
+def configure_client(**kwargs) -> None:
+    """
+    修改MongoClient的连接参数（如host, port, maxPoolSize），关闭当前进程已创建的client，下次使用时按新参数创建
+
+    configure_client(host='10.0.0.2', maxPoolSize=32)
+    """
+    global _CLIENT, _CLIENT_PID
+    with _CLIENT_LOCK:
+        MONGO_CONFIG.update(kwargs)
+        if _CLIENT is not None and _CLIENT_PID == os.getpid():
+            _CLIENT.close()
+        _CLIENT, _CLIENT_PID = None, None
+
+
+def _reset_client_after_fork() -> None:
+    # fork时其他线程可能持有锁，子进程中换一把新锁；父进程的client留给父进程，子进程只丢弃引用
+    global _CLIENT, _CLIENT_PID, _CLIENT_LOCK
+    _CLIENT, _CLIENT_PID = None, None
+    _CLIENT_LOCK = threading.Lock()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_client_after_fork)
+
+
+class LazyClient(object):
+    __doc__ = """
+    MongoClient的代理，用法与MongoClient相同（client['db']['collection']），
+    import模块时不建立连接，第一次访问时才通过get_client()获取进程内共用的MongoClient
+    """
+
+    def __getitem__(self, name):
+        return get_client()[name]
+
+    def __getattr__(self, name):
+        # 避免pickle/copy等查找特殊方法时建立连接
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return getattr(get_client(), name)
+
+
+def get_newest_date(collection, time_query_key='TRADE_DT'):
+    """
+    取出collection中最新的日期，只返回一个字段，有time_query_key索引时不需要扫描整个collection
+
+    :param collection: mongodb collection
+    :param time_query_key: 日期字段名
+    :return: 数据库中储存的日期（原格式），collection为空时返回None
+    """
+    doc = collection.find_one({}, {time_query_key: 1, '_id': 0}, sort=[(time_query_key, pymongo.DESCENDING)])
+    return None if doc is None else doc[time_query_key]
+
+
+def get_meta(collection):
+    """
+    读取collection的元数据，按_id（collection名）查询，只需要一次索引读取：
+        {'_id': 名称, 'time_index': 'TRADE_DT', 'min_date': datetime, 'max_date': datetime, 'count': 文档数,
+         'updated_at': 最后写入时间(UTC)}
+
+    :return: dict，没有记录时返回None
+    """
+    return collection.database[META_COLLECTION].find_one({'_id': collection.name})
+
+
+def refresh_meta(collection, time_index='TRADE_DT') -> dict:
+    """
+    重新统计collection的元数据：最早、最新日期各一次排序查询，文档数取自collection的统计信息。
+    用于第一次登记已有的collection，或collection被mongodb_utils以外的程序修改之后
+    """
+    oldest = collection.find_one({}, {time_index: 1, '_id': 0}, sort=[(time_index, pymongo.ASCENDING)])
+    newest = get_newest_date(collection, time_index)
+    return _write_meta(collection, time_index,
+                       None if oldest is None else parse_date(oldest[time_index]),
+                       None if newest is None else parse_date(newest))
+
+
+def record_write(collection, dates, time_index='TRADE_DT', deleted=None, replace=False) -> dict:
+    """
+    写入后增量更新元数据，不需要查询collection；creat_mongodb、upsert_range和insert_new_factor写入后自动调用
+
+    :param dates: 本次写入的日期（任意储存格式）
+    :param deleted: 本次删除或整体替换的区间(sdt, edt)，见upsert_range
+    :param replace: collection写入前为空，不合并已有的元数据
+    """
+    dates = decode_dates(dates)
+    dates = dates[~np.isnat(dates)]
+    lo, hi = (pd.Timestamp(dates.min()), pd.Timestamp(dates.max())) if len(dates) else (None, None)
+
+    meta = None if replace else get_meta(collection)
+    if meta is None:
+        if not replace:
+            return refresh_meta(collection, time_index)
+        return _write_meta(collection, time_index, lo, hi)
+
+    old_lo = None if meta.get('min_date') is None else pd.Timestamp(meta['min_date'])
+    old_hi = None if meta.get('max_date') is None else pd.Timestamp(meta['max_date'])
+    if deleted is not None and old_lo is not None:
+        sdt, edt = parse_date(deleted[0]), parse_date(deleted[1]) + pd.Timedelta(1, unit='d')
+        lo_hit, hi_hit = sdt <= old_lo < edt, sdt <= old_hi < edt
+        if (lo_hit or hi_hit) and len(dates) == 0:
+            # 删除了最早或最新的日期，区间外剩余的日期未知，重新统计
+            return refresh_meta(collection, time_index)
+        # 原来的最早（最新）日期在替换区间内时，区间外没有更早（更晚）的日期，新的边界即为写入的日期
+        old_lo = None if lo_hit else old_lo
+        old_hi = None if hi_hit else old_hi
+    return _write_meta(collection, time_index,
+                       min([x for x in [old_lo, lo] if x is not None], default=None),
+                       max([x for x in [old_hi, hi] if x is not None], default=None))
+
+
+def _write_meta(collection, time_index, min_date, max_date) -> dict:
+    doc = {
+        'time_index': time_index,
+        'min_date': None if min_date is None else min_date.to_pydatetime(),
+        'max_date': None if max_date is None else max_date.to_pydatetime(),
+        'count': collection.estimated_document_count(),
+        'updated_at': datetime.datetime.now(datetime.timezone.utc)
+    }
+    collection.database[META_COLLECTION].update_one({'_id': collection.name}, {'$set': doc}, upsert=True)
+    return {'_id': collection.name, **doc}
+
+
+def get_max_date(collection, time_index='TRADE_DT'):
+    """
+    collection中最新的日期，见get_max_dates
+
+    :return: pd.Timestamp，collection为空时返回None
+    """
+    return get_max_dates([collection], time_index)[collection.full_name]
+
+
+def get_max_dates(collections, time_index='TRADE_DT') -> dict:
+    """
+    批量读取多个collection最新的日期，用于一次确定整个因子库中哪些因子需要更新：
+        * 本模块写入的collection（因子、Trade_Dates、BenchMarks）读取元数据，同一database只需要一次按_id的查询，
+          没有登记时用get_newest_date查询并登记
+        * EXTERNAL_COLLECTIONS（如行情）由外部程序写入，元数据不会更新，每次都用get_newest_date直接查询
+
+    :return: {collection.full_name: pd.Timestamp or None}
+    """
+    out = {}
+    by_db = {}
+    for collection in collections:
+        if collection.full_name in EXTERNAL_COLLECTIONS:
+            newest = get_newest_date(collection, time_index)
+            out[collection.full_name] = None if newest is None else parse_date(newest)
+            continue
+        by_db.setdefault(collection.database.name, []).append(collection)
+    for group in by_db.values():
+        metas = {meta['_id']: meta for meta in group[0].database[META_COLLECTION].find(
+            {'_id': {'$in': [collection.name for collection in group]}})}
+        for collection in group:
+            meta = metas.get(collection.name)
+            if meta is None:
+                meta = refresh_meta(collection, time_index)
+            out[collection.full_name] = None if meta['max_date'] is None else pd.Timestamp(meta['max_date'])
+    return out
+
+
+def get_date_format(collection, time_query_key='TRADE_DT'):
+    """
+    探测collection中日期的储存格式，只读取一个文档的time_query_key字段：
+        * 'str': 'YYYY-MM-DD'或'YYYY-MM-DD HH:MM:SS'字符串（to_json_from_pandas的格式）
+        * 'date': BSON date，读取时直接解码为datetime
+        * 'int': YYYYMMDD整数
+
+    :return: 'str', 'date' or 'int'，collection为空时返回None
+    """
+    doc = collection.find_one({time_query_key: {'$exists': True}}, {time_query_key: 1, '_id': 0})
+    if doc is None:
+        return None
+    value = doc[time_query_key]
+    if isinstance(value, datetime.datetime):
+        return 'date'
+    if isinstance(value, (int, np.integer)) and not isinstance(value, bool):
+        return 'int'
+    return 'str'
+
+
+def encode_date(value, date_format='str'):
+    """
+    把一个日期转换为数据库中的储存格式，用于查询条件
+
+    :param value: 任意格式的日期，如'2021-01-04', 20210104, datetime
+    :param date_format: 'str', 'date' or 'int'，见get_date_format
+    """
+    date = parse_date(value)
+    if date_format == 'date':
+        return date.to_pydatetime()
+    if date_format == 'int':
+        return date.year * 10000 + date.month * 100 + date.day
+    # 'YYYY-MM-DD'与两种字符串格式按字典序比较的结果都正确
+    return date.strftime('%Y-%m-%d')
+
+
+def encode_dates(data, time_index='TRADE_DT', date_format='str') -> pd.DataFrame:
+    """
+    把data的日期列转换为数据库中的储存格式，不修改输入的data：
+    'date'转换为datetime64（to_records需native_dates=True），'int'转换为YYYYMMDD整数，'str'保持不变
+
+    :param date_format: 'str', 'date' or 'int'，见get_date_format
+    """
+    if date_format not in ['str', 'date', 'int']:
+        raise NotImplementedError('please enter the right date_format: "str", "date", "int".')
+    if date_format == 'str' or time_index not in data.columns or len(data) == 0:
+        return data
+    dates = pd.DatetimeIndex(decode_dates(data[time_index].values))
+    if date_format == 'int':
+        dates = dates.year * 10000 + dates.month * 100 + dates.day
+    return data.assign(**{time_index: np.asarray(dates)})
+
+
+def decode_dates(values) -> np.ndarray:
+    """
+    把数据库中读取的日期转换为datetime64[ns]数组：
+        * BSON date已是datetime，不需要解析
+        * YYYYMMDD整数按年、月、日直接计算
+        * 字符串只解析去重后的值，每个值单独推断格式（同一collection中可能同时有'YYYY-MM-DD'和'YYYY-MM-DD HH:MM:SS'），
+          无法解析时抛出ValueError并列出无法解析的值
+
+    :param values: 日期数组，缺失值为None/NaN
+    """
+    values = np.asarray(values)
+    if np.issubdtype(values.dtype, np.datetime64):
+        return values.astype('datetime64[ns]')
+    kind = pd.api.types.infer_dtype(values, skipna=True)
+    if kind in ['integer', 'floating', 'mixed-integer-float']:
+        values = pd.to_numeric(values, errors='coerce').astype(np.float64)
+        out = np.full(len(values), np.datetime64('NaT'), dtype='datetime64[ns]')
+        valid = ~np.isnan(values)
+        ymd = values[valid].astype(np.int64)
+        months = (ymd // 10000 - 1970).astype('datetime64[Y]').astype('datetime64[M]') + (ymd // 100 % 100 - 1)
+        out[valid] = months.astype('datetime64[D]') + (ymd % 100 - 1)
+        return out
+    if kind == 'string':
+        codes, uniques = pd.factorize(values)
+        try:
+            dates = pd.to_datetime(uniques, **_MIXED_FORMAT).values.astype('datetime64[ns]')
+        except (ValueError, OverflowError) as e:
+            bad = [str(x) for x in uniques if pd.isna(pd.to_datetime(x, errors='coerce'))]
+            raise ValueError(f'cannot parse {len(bad)} date values, e.g. {bad[:5]}') from e
+        return np.where(codes >= 0, dates[np.maximum(codes, 0)], np.datetime64('NaT'))
+    return pd.to_datetime(values, **_MIXED_FORMAT).values.astype('datetime64[ns]')
+
+
+def parse_date(value) -> pd.Timestamp:
+    """
+    把任意储存格式的一个日期（如get_newest_date的返回值）转换为Timestamp
+    """
+    return pd.Timestamp(decode_dates([value])[0])
+
+
+def _date_query(start_date, end_date=None, date_format='str') -> dict:
+    """
+    [start_date, end_date]闭区间的查询条件，日期转换为collection中的储存格式，end_date为None表示不设上限
+    """
+    query = {'$gte': encode_date(start_date, date_format)}
+    if end_date is not None:
+        # 右端延后一天，字符串储存时'YYYY-MM-DD HH:MM:SS'也落在区间内
+        query['$lt'] = encode_date(parse_date(end_date) + pd.Timedelta(1, unit='d'), date_format)
+    return query
+
+
+def migrate_dates(collection, time_index='TRADE_DT', date_format='date') -> int:
+    """
+    把已有collection中字符串储存的日期原地转换为date_format，在数据库端用aggregation pipeline更新（MongoDB 4.2+），
+    不需要把数据读回python；只转换仍为字符串的文档，中途失败后重新运行即可。已有的索引不需要重建
+
+    :param date_format: 'date' or 'int'
+    :return: 转换的文档数
+    """
+    field = '$' + time_index
+    if date_format == 'date':
+        target = {'$dateFromString': {'dateString': {'$substrBytes': [field, 0, 10]}, 'format': '%Y-%m-%d'}}
+    elif date_format == 'int':
+        target = {'$toInt': {'$concat': [{'$substrBytes': [field, 0, 4]}, {'$substrBytes': [field, 5, 2]},
+                                         {'$substrBytes': [field, 8, 2]}]}}
+    else:
+        raise NotImplementedError('please enter the right date_format: "date", "int".')
+
+    t0 = time.perf_counter()
+    print(f'Start migrating {collection.full_name}.{time_index} to {date_format}')
+    result = collection.update_many({time_index: {'$type': 'string'}}, [{'$set': {time_index: target}}])
+    print(f'Migrated {result.modified_count} documents, time = {round(time.perf_counter() - t0, 1)}s')
+    return result.modified_count
+
+
+@contextmanager
+def fetch_cache():
+    """
+    在with语句内缓存fetch_data的结果，同一collection、同一组字段的数据只从数据库读取一次，
+    之后落在已读取区间内的请求直接从缓存中切片返回（拷贝），用于多个因子共用同一份原始数据
+
+    with fetch_cache():
+        factor1.prepare_data(sdt, edt)
+        factor2.prepare_data(sdt, edt)
+    """
+    global _FETCH_CACHE
+    outer = _FETCH_CACHE
+    if outer is None:
+        _FETCH_CACHE = {}
+    try:
+        yield
+    finally:
+        if outer is None:
+            _FETCH_CACHE = None
+
 
 def to_json_from_pandas(data):
     """
@@ -21,140 +386,440 @@ def to_json_from_pandas(data):
         Not described
     """
 
-    """需要对于TRADE_DT进行转换, 以免直接被变成了时间戳"""
-    if 'TRADE_DT' in data.columns:
-        data.TRADE_DT = data.TRADE_DT.apply(str)
-    return json.loads(data.to_json(orient='records'))
+    """需要对于TRADE_DT进行转换, 以免直接被变成了时间戳；不再修改输入的data，见to_records"""
+    return to_records(data)
+
+
+def to_records(data, nan_policy='null', native_dates=False) -> list:
+    """
+    把DataFrame按列转换为可以直接insert_many的文档列表，不修改、不拷贝输入的data：
+        * 每列用tolist()一次转换为python对象（numpy的int/float/bool转为python类型）
+        * NaN/NaT/None按nan_policy处理：'null'储存为null，'omit'不写入该字段
+        * 日期列默认转换为与str(Timestamp)一致的'YYYY-MM-DD HH:MM:SS'字符串（与数据库中已有的格式一致），
+          native_dates=True时保留为datetime
+
+    :param data: DataFrame
+    :param nan_policy: 'null' or 'omit'
+    :param native_dates: 日期是否以datetime储存
+    :return: list of dict
+    """
+    if nan_policy not in ['null', 'omit']:
+        raise NotImplementedError('please enter the right nan_policy: "null", "omit".')
+
+    columns, values = _encode_columns(data, native_dates)
+    if nan_policy == 'null' or not any(None in lst for lst in values):
+        return [dict(zip(columns, row)) for row in zip(*values)]
+    return [{k: v for k, v in zip(columns, row) if v is not None} for row in zip(*values)]
 
 
-def creat_mongodb(data, collection, id_index, time_index):
+def _encode_columns(data, native_dates=False):
+    """
+    to_records和to_day_buckets共用的按列编码，返回(列名, 每列的python对象列表)，缺失值为None
+    """
+    columns = [str(col) for col in data.columns]
+    values = []
+    for i in range(data.shape[1]):
+        col = data.iloc[:, i]
+        missing = np.flatnonzero(pd.isna(col.values))
+        if pd.api.types.is_datetime64_any_dtype(col.dtype):
+            col = pd.DatetimeIndex(col)
+            lst = list(col.to_pydatetime()) if native_dates else col.strftime('%Y-%m-%d %H:%M:%S').tolist()
+        elif isinstance(col.dtype, pd.CategoricalDtype):
+            lst = col.astype(object).tolist()
+        else:
+            lst = col.values.tolist()
+        # 只对缺失值逐个替换
+        for k in missing:
+            lst[k] = None
+        values.append(lst)
+    return columns, values
+
+
+def benchmark_encode(data, repeat=3) -> pd.DataFrame:
+    """
+    比较to_records与原来的to_json/json.loads往返的编码速度
+
+    :param data: 待编码的DataFrame，如长表格式的因子值
+    :return: DataFrame，index为编码方式，列为最短耗时（秒）和每秒行数
+    """
+    def roundtrip(df):
+        df = df.copy()
+        if 'TRADE_DT' in df.columns:
+            df.TRADE_DT = df.TRADE_DT.apply(str)
+        return json.loads(df.to_json(orient='records'))
+
+    result = {}
+    for name, func in [('json_roundtrip', roundtrip), ('to_records', to_records)]:
+        times = []
+        for _ in range(repeat):
+            t0 = time.perf_counter()
+            func(data)
+            times.append(time.perf_counter() - t0)
+        result[name] = {'seconds': min(times), 'rows_per_second': len(data) / max(min(times), 1e-9)}
+    return pd.DataFrame(result).T
+
+
+def creat_mongodb(data, collection, id_index, time_index, batch_size=100000, n_jobs=4, defer_index=True,
+                  unique=False, layout='row', date_format='str'):
     """
     在mongodb数据库中创建新的collection，把data存入该collection中，并制定索引
+        * data按batch_size切分，n_jobs个线程同时编码、写入，一个线程编码时其他线程的insert在等待数据库，两者重叠
+        * insert_many使用ordered=False，数据库可以并行写入同一批文档
+        * defer_index=True时写入完成后再建立索引，避免每次插入都维护索引
+
+    :param batch_size: 每次insert_many的文档数（layout='day'时为行数，按交易日取整）
+    :param n_jobs: 同时写入的线程数，MongoClient自带连接池，多个线程可以共用同一个client
+    :param defer_index: 是否在写入完成后再建立索引
+    :param unique: 是否建立唯一索引（见ensure_unique_index），之后可以用upsert_range幂等地更新
+    :param layout: 储存格式，'row': 每个(ticker, 交易日)一个文档；'day': 每个交易日一个文档（见to_day_buckets），
+                   总是建立time_index上的唯一索引
+    :param date_format: 日期的储存格式，'str', 'date' or 'int'，见get_date_format
     """
-    collection.create_index(
-        [
-            (id_index,
-             pymongo.ASCENDING),
-            (time_index,
-             pymongo.ASCENDING)
-        ]
-    )
+    if layout not in ['row', 'day']:
+        raise NotImplementedError('please enter the right layout: "row", "day".')
+    data = encode_dates(data, time_index, date_format)
+    native_dates = date_format == 'date'
+    empty = collection.estimated_document_count() == 0
+    if layout == 'day':
+        data = _sort_by_date(data, time_index)
+        slices = _date_slices(data, time_index, batch_size)
+    else:
+        slices = [(i, i + batch_size) for i in range(0, data.shape[0], batch_size)]
+
+    def create_index():
+        if layout == 'day':
+            ensure_unique_index(collection, None, time_index)
+            return
+        if unique:
+            ensure_unique_index(collection, id_index, time_index)
+            return
+        collection.create_index(
+            [
+                (id_index,
+                 pymongo.ASCENDING),
+                (time_index,
+                 pymongo.ASCENDING)
+            ]
+        )
 
-    period = 100000
+    def insert(bounds):
+        block = data.iloc[bounds[0]:bounds[1], :]
+        if layout == 'day':
+            temp = to_day_buckets(block, time_index, native_dates)
+        else:
+            temp = to_records(block, native_dates=native_dates)
+        collection.insert_many(temp, ordered=False)
+        return len(temp)
+
+    if not defer_index:
+        create_index()
+
+    t0 = time.perf_counter()
     l = data.shape[0]
-    for i in tqdm(range(0, l, period)):
-        start_index = i
-        end_index = i + period if i + period <= l else l
-        print('Start Transforming')
-        temp = to_json_from_pandas(data.iloc[start_index:end_index, :])
-        print('Transform successfully')
-        print('Start Insert mongodb')
-        collection.insert_many(temp)
-        print('Insert successfully')
+    print(f'Start Insert mongodb: {l} rows, batch_size = {batch_size}, n_jobs = {n_jobs}, layout = {layout}')
+    with ThreadPoolExecutor(max_workers=max(n_jobs, 1)) as executor:
+        # 任务只持有data的切片，编码后的文档在线程中生成，内存中最多同时有n_jobs批文档
+        futures = [executor.submit(insert, bounds) for bounds in slices]
+        for future in tqdm(futures):
+            future.result()
+    seconds = time.perf_counter() - t0
+    print(f'Insert successfully: {round(l / max(seconds, 1e-9))} rows/s, time = {round(seconds, 1)}s')
+
+    if defer_index:
+        t0 = time.perf_counter()
+        create_index()
+        print(f'Index built, time = {round(time.perf_counter() - t0, 1)}s')
+    record_write(collection, data[time_index].values, time_index, replace=empty)
     print('End mongodb')
     return 0
 
 
-def insert_new_data(data, collection, time_query_key='TRADE_DT', date_list=None):
+def ensure_unique_index(collection, id_index='S_INFO_WINDCODE', time_index='TRADE_DT') -> str:
+    """
+    确保collection上有(time_index, id_index)的唯一索引
+        * 以time_index开头，按日期区间的查询和删除（见upsert_range）可以使用该索引
+        * 已有的其他索引（如(id_index, time_index)的非唯一索引）保留
+        * 已有同样字段的非唯一索引时，先确认没有重复的文档再替换，重建失败时恢复原来的索引
+
+    :param id_index: ticker字段名，None表示只按日期唯一（如Trade_Dates, BenchMarks）
+    :return: 索引名
+    """
+    keys = [(key, pymongo.ASCENDING) for key in [time_index, id_index] if key is not None]
+    fields = [k for k, _ in keys]
+    error = f'{collection.full_name} has duplicated {fields} documents, please delete the affected range first'
+    for name, info in collection.index_information().items():
+        if [(k, int(v)) for k, v in info['key']] == keys:
+            if info.get('unique'):
+                return name
+            # 同样字段只能有一个索引，只有确认没有重复的文档后才删除原来的索引
+            duplicated = collection.aggregate([
+                {'$group': {'_id': {k: f'${k}' for k in fields}, 'n': {'$sum': 1}}},
+                {'$match': {'n': {'$gt': 1}}},
+                {'$limit': 1}
+            ], allowDiskUse=True)
+            if next(duplicated, None) is not None:
+                raise ValueError(error)
+            collection.drop_index(name)
+            try:
+                return collection.create_index(keys, unique=True)
+            except pymongo.errors.DuplicateKeyError as e:
+                collection.create_index(keys, name=name)
+                raise ValueError(error) from e
+    try:
+        return collection.create_index(keys, unique=True)
+    except pymongo.errors.DuplicateKeyError as e:
+        raise ValueError(error) from e
+
+
+def upsert_range(data, collection, id_index='S_INFO_WINDCODE', time_index='TRADE_DT', sdt=None, edt=None,
+                 batch_size=10000, n_jobs=4, layout=None, date_format=None, unique=False) -> dict:
+    """
+    幂等写入，save、update_factor、del_factor和insert_new_data共用：
+        * 给定sdt, edt时替换整个区间：先删除区间内不在data中的文档，data为空时即删除整个区间
+          区间内已有文档的(time_index, id_index)用一次区间查询读出，在本地比较后按_id删除
+        * data中的文档按(id_index, time_index)upsert，只$set data中的字段，文档的其他字段保留
+        * 文档已存在且字段值相同时数据库不做修改，中途失败后重新运行只会写入缺失或变化的文档
+        * 按交易日分桶的collection（见to_day_buckets）每个交易日整体替换，data中的字段即为文档的全部字段
+
+    :param data: 长表格式的DataFrame，必须包含id_index和time_index
+    :param id_index: ticker字段名，None表示只按日期匹配
+    :param sdt: 替换区间的起始日期 YYYY-MM-DD，None表示不删除
+    :param edt: 替换区间的结束日期 YYYY-MM-DD（包含）
+    :param batch_size: 每次bulk_write的操作数（分桶时为行数，按交易日取整）
+    :param n_jobs: 同时写入的线程数
+    :param layout: 'row' or 'day'，None表示按collection中已有的文档探测（见get_layout）
+    :param date_format: 日期的储存格式，None表示按collection中已有的文档探测，空collection为'str'（见get_date_format）
+    :param unique: 是否在写入前确保(time_index, id_index)的唯一索引（见ensure_unique_index），
+                   只用于本项目管理的collection（如因子），行情等数据源的索引不做修改
+    :return: {'deleted', 'matched', 'modified', 'upserted'}
+    """
+    if layout is None:
+        layout = get_layout(collection)
+    if date_format is None:
+        date_format = get_date_format(collection, time_index) or 'str'
+    data = encode_dates(data, time_index, date_format)
+    native_dates = date_format == 'date'
+    keys = [key for key in [id_index, time_index] if key is not None]
+    counts = dict.fromkeys(['deleted', 'matched', 'modified', 'upserted'], 0)
+    t0 = time.perf_counter()
+
+    if len(data) != 0 and data.duplicated(subset=keys).any():
+        data = data.drop_duplicates(subset=keys, keep='last')
+
+    if sdt is not None and edt is not None:
+        time_query = {time_index: _date_query(sdt, edt, date_format)}
+        # 区间内没有文档（如每天更新新的交易日）时不需要删除
+        if collection.find_one(time_query, {'_id': 1}) is not None:
+            if len(data) == 0:
+                requests = [pymongo.DeleteMany(time_query)]
+            else:
+                # 分桶时同一交易日的ticker在替换文档时一并更新，只需删除不在data中的交易日
+                delete_keys = keys if layout == 'row' else [time_index]
+                existing = pd.DataFrame(list(collection.find(time_query, {key: 1 for key in delete_keys})),
+                                        columns=['_id'] + delete_keys)
+                encoded = pd.DataFrame(to_records(data[delete_keys], native_dates=native_dates),
+                                       columns=delete_keys)
+                stale = ~pd.MultiIndex.from_frame(existing[delete_keys]).isin(
+                    pd.MultiIndex.from_frame(encoded))
+                ids = existing['_id'].values[stale].tolist()
+                requests = [pymongo.DeleteMany({'_id': {'$in': ids[i:i + batch_size]}})
+                            for i in range(0, len(ids), batch_size)]
+            if requests:
+                counts['deleted'] = collection.bulk_write(requests, ordered=False).deleted_count
+
+    if len(data) != 0:
+        if layout == 'day':
+            data = _sort_by_date(data, time_index)
+            slices = _date_slices(data, time_index, batch_size)
+        else:
+            slices = [(i, i + batch_size) for i in range(0, len(data), batch_size)]
+        if unique:
+            ensure_unique_index(collection, id_index if layout == 'row' else None, time_index)
+
+        def upsert(bounds):
+            block = data.iloc[bounds[0]:bounds[1], :]
+            if layout == 'day':
+                requests = [pymongo.ReplaceOne({time_index: i[time_index]}, i, upsert=True)
+                            for i in to_day_buckets(block, time_index, native_dates)]
+            else:
+                requests = [pymongo.UpdateOne({key: i[key] for key in keys}, {'$set': i}, upsert=True)
+                            for i in to_records(block, native_dates=native_dates)]
+            result = collection.bulk_write(requests, ordered=False)
+            return result.matched_count, result.modified_count, result.upserted_count
+
+        with ThreadPoolExecutor(max_workers=max(n_jobs, 1)) as executor:
+            futures = [executor.submit(upsert, bounds) for bounds in slices]
+            for future in tqdm(futures):
+                for key, n in zip(['matched', 'modified', 'upserted'], future.result()):
+                    counts[key] += n
+
+    record_write(collection, data[time_index].values if len(data) else [], time_index,
+                 deleted=(sdt, edt) if sdt is not None and edt is not None else None)
+    seconds = time.perf_counter() - t0
+    print(f'{collection.full_name}: {counts}, {round(len(data) / max(seconds, 1e-9))} rows/s, '
+          f'time = {round(seconds, 1)}s')
+    return counts
+
+
+def get_layout(collection) -> str:
+    """
+    探测collection的储存格式，只读取一个文档的LAYOUT_KEY字段
+
+    :return: 'day': 按交易日分桶（见to_day_buckets）；'row': 每个(ticker, 交易日)一个文档，空collection也返回'row'
+    """
+    doc = collection.find_one({}, {LAYOUT_KEY: 1, '_id': 0})
+    return 'row' if doc is None else doc.get(LAYOUT_KEY, 'row')
+
+
+def to_day_buckets(data, time_index='TRADE_DT', native_dates=False) -> list:
+    """
+    把长表转换为按交易日分桶的文档：每个交易日一个文档，time_index以外的每一列储存为一个数组，
+    各数组按位置对应（第k个ticker的值在每个数组的第k个位置），缺失值为null，'_n'为该交易日的行数，
+    字段顺序与data的列顺序（即逐行储存时文档的字段顺序）一致
+
+    {'_layout': 'day', '_n': 2, 'TRADE_DT': '2021-10-08',
+     'S_INFO_WINDCODE': ['000001.SZ', '000002.SZ'], 'f00001': [0.012, null]}
+
+    :param data: 长表格式的DataFrame，必须包含time_index
+    :param native_dates: 日期是否以datetime储存，见to_records
+    :return: list of dict，按time_index升序
+    """
+    columns, values = _encode_columns(data, native_dates)
+    k = columns.index(time_index)
+    codes, dates = pd.factorize(np.asarray(values[k], dtype=object), sort=True)
+    order = np.argsort(codes, kind='stable')
+    bounds = np.searchsorted(codes[order], np.arange(len(dates) + 1))
+    arrays = [None if i == k else np.asarray(lst, dtype=object)[order] for i, lst in enumerate(values)]
+
+    docs = []
+    for i, dt in enumerate(dates):
+        doc = {LAYOUT_KEY: 'day', '_n': int(bounds[i + 1] - bounds[i])}
+        doc.update({col: dt if arr is None else arr[bounds[i]:bounds[i + 1]].tolist()
+                    for col, arr in zip(columns, arrays)})
+        docs.append(doc)
+    return docs
+
+
+def from_day_buckets(docs, factor_ls=None) -> pd.DataFrame:
+    """
+    to_day_buckets的逆变换：把分桶文档展开为长表，数组按文档顺序拼接，标量字段（如TRADE_DT, _id）按'_n'重复，
+    列顺序与文档的字段顺序一致，与逐行储存时find返回的列相同（_id为所在分桶文档的_id）
+
+    :param docs: 分桶文档，可以是游标
+    :param factor_ls: 返回的列，None表示文档中的所有字段，文档中有_id时总是返回
+    """
+    docs = list(docs)
+    columns = list(dict.fromkeys(key for doc in docs for key in doc if key not in [LAYOUT_KEY, '_n']))
+    if factor_ls is not None:
+        columns = [key for key in columns if key == '_id' or key in factor_ls]
+    out = {}
+    for col in columns:
+        lst = []
+        for doc in docs:
+            value = doc.get(col)
+            lst.extend(value if isinstance(value, list) else [value] * doc['_n'])
+        out[col] = lst
+    return pd.DataFrame(out, columns=columns)
+
+
+def _sort_by_date(data, time_index='TRADE_DT') -> pd.DataFrame:
+    # 分桶写入前保证同一交易日的行相邻
+    if data[time_index].is_monotonic_increasing:
+        return data
+    return data.sort_values(time_index, kind='stable')
+
+
+def _date_slices(data, time_index, batch_size) -> list:
+    """
+    把按time_index排序的data切分为约batch_size行的区间，同一交易日的行不会被分到两个区间
+
+    :return: [(start, end)]，行的位置
+    """
+    dates = data[time_index].values
+    starts = np.flatnonzero(np.r_[True, dates[1:] != dates[:-1]]) if len(dates) else []
+    bounds = [0]
+    for start in starts:
+        if start - bounds[-1] >= batch_size:
+            bounds.append(int(start))
+    return list(zip(bounds, bounds[1:] + [len(dates)]))
+
+
+def insert_new_data(data, collection, time_query_key='TRADE_DT', date_list=None, id_index='S_INFO_WINDCODE'):
     """
     插入每天新的数据，会自动检索数据库中最新的日期，只插入最新日期至今的数据
+    按(id_index, time_query_key)幂等写入（见upsert_range），重复运行不会产生重复的文档，不修改collection的索引
+
+    :param id_index: ticker字段名，None表示只按日期匹配
     """
 
-    if ~data.empty:
+    if not data.empty:
         data = data.drop_duplicates()
-        newest_date_inDB = pd.to_datetime(
-            pd.DataFrame.from_records(
-                list(
-                    collection.find().sort([(time_query_key, -1)]).limit(1)
-                )
-            )[time_query_key][0][:10]
-        )
+        newest_date_inDB = parse_date(get_newest_date(collection, time_query_key)).normalize()
 
         if date_list is None:
             Data_insert = data[data[time_query_key] >= newest_date_inDB]
+            # 替换数据库中最新一天至今的数据
+            sdt = newest_date_inDB.strftime('%Y-%m-%d')
+            edt = pd.to_datetime(Data_insert[time_query_key].max()).strftime('%Y-%m-%d') if len(Data_insert) else None
         else:
             Data_insert = data[data[time_query_key].isin(date_list)]
-        # 删除数据库中最新一天的数据，存入那天开始至今的数据
-        delete_condition = {time_query_key: newest_date_inDB}
-        collection.delete_many(delete_condition)
-        # 如果dataframe不大，直接存数据库
-        # 如果dataframe过大，则一部分一部分存
-        if Data_insert.shape[0] <= 100000:
-            print()
-            print('Start Transforming')
-            temp = to_json_from_pandas(Data_insert)
-            print('Transform successfully')
-            print('Start Insert mongodb')
-            collection.insert_many(temp)
-            print('End mongodb')
-        else:  # 一次存100000条
-            period = 100000
-            l = Data_insert.shape[0]
-            for i in tqdm(range(0, l, period)):
-                print(str(i / l * 100) + '%')
-                start_index = i
-                end_index = i + period if i + period <= l else l
-                print()
-                print('Start Transforming')
-                temp = to_json_from_pandas(Data_insert.iloc[start_index:end_index, :])
-                print('Transform successfully')
-                print('Start Insert mongodb')
-                collection.insert_many(temp)
-                print('Insert successfully')
-            print('End mongodb')
+            sdt, edt = None, None
+        upsert_range(Data_insert, collection, id_index, time_query_key, sdt=sdt, edt=edt)
+        print('End mongodb')
     else:
         print('The data is empty! Please Check your input!')
         return 0
 
 
-def insert_new_factor(data, collection, factor_name, time_query_key='TRADE_DT'):
+def insert_new_factor(data, collection, factor_name, time_query_key='TRADE_DT', batch_size=10000, n_jobs=4):
     """
     向数据库中插入新一列因子值，不能包含其他因子，格式一致
     输入factor_name 为 string 类型，需要与data中的列名一致
+    按(S_INFO_WINDCODE, time_query_key)匹配已有文档，每batch_size条UpdateOne合并为一次无序的bulk_write，
+    n_jobs个线程同时写入
     """
 
-    if ~data.empty:
-        newest_date_inDB = pd.to_datetime(
-            pd.DataFrame.from_records(list(collection.find().sort([(time_query_key, -1)]).limit(1)))[time_query_key][0][
-            :10])
-        Data_insert = data[data[time_query_key] <= newest_date_inDB]
-
-        # 如果dataframe不大，直接存数据库
-        # 如果dataframe过大，则一部分一部分存
-        if Data_insert.shape[0] <= 100000:
-            print()
-            print('Start Transforming')
-            temp = to_json_from_pandas(Data_insert)
-            print('Transform successfully')
-            print('Start Insert mongodb')
-            for i in tqdm(temp):
-                collection.update_one({'S_INFO_WINDCODE': i['S_INFO_WINDCODE'], time_query_key: i[time_query_key]},
-                                      {'$set': {factor_name: i[factor_name]}})
-
-            print('End mongodb')
-        else:  # 一次存100000条
-            period = 100000
-            l = Data_insert.shape[0]
-            for i in range(0, l, period):
-                print(str(i / l * 100) + '%')
-                start_index = i
-                end_index = i + period if i + period <= l else l
-                print()
-                print('Start Transforming')
-                temp = to_json_from_pandas(Data_insert.iloc[start_index:end_index, :])
-                print('Transform successfully')
-                print('Start Insert mongodb')
-                for i in tqdm(temp):
-                    collection.update_one({'S_INFO_WINDCODE': i['S_INFO_WINDCODE'], time_query_key: i[time_query_key]},
+    if get_layout(collection) == 'day':
+        raise NotImplementedError(f'{collection.full_name} is stored by day buckets, '
+                                  f'please rewrite the whole range with upsert_range')
+
+    if not data.empty:
+        date_format = get_date_format(collection, time_query_key) or 'str'
+        newest_date_inDB = parse_date(get_newest_date(collection, time_query_key)).normalize()
+        Data_insert = data.loc[data[time_query_key] <= newest_date_inDB, ['S_INFO_WINDCODE', time_query_key, factor_name]]
+        Data_insert = encode_dates(Data_insert, time_query_key, date_format)
+
+        def update(start_index):
+            temp = to_records(Data_insert.iloc[start_index:start_index + batch_size, :],
+                              native_dates=date_format == 'date')
+            requests = [pymongo.UpdateOne({'S_INFO_WINDCODE': i['S_INFO_WINDCODE'], time_query_key: i[time_query_key]},
                                           {'$set': {factor_name: i[factor_name]}})
-                print('Insert successfully')
-            print('End mongodb')
+                        for i in temp]
+            result = collection.bulk_write(requests, ordered=False)
+            return result.matched_count, result.modified_count
+
+        t0 = time.perf_counter()
+        l = Data_insert.shape[0]
+        print(f'Start Update mongodb: {l} rows, batch_size = {batch_size}, n_jobs = {n_jobs}')
+        matched, modified = 0, 0
+        with ThreadPoolExecutor(max_workers=max(n_jobs, 1)) as executor:
+            futures = [executor.submit(update, i) for i in range(0, l, batch_size)]
+            for future in tqdm(futures):
+                m, n = future.result()
+                matched, modified = matched + m, modified + n
+        seconds = time.perf_counter() - t0
+        print(f'Matched {matched}, modified {modified}: {round(l / max(seconds, 1e-9))} rows/s, '
+              f'time = {round(seconds, 1)}s')
+        # 只修改已有文档，日期范围不变，只更新写入时间
+        record_write(collection, [], time_query_key)
+        print('End mongodb')
     else:
         print('The data is empty! Please Check your input!')
         return 0
 
 
-def fetch_data(start_date, end_date, collection, time_query_key='TRADE_DT', factor_ls=None):
+def fetch_data(start_date, end_date, collection, time_query_key='TRADE_DT', factor_ls=None, use_cache=True,
+               columnar=False, float_dtype=np.float64, batch_size=50000, n_jobs=1):
     """
     从数据库中读取需要指定日期范围的数据,包含startdate，包含enddate
 
@@ -164,23 +829,43 @@ def fetch_data(start_date, end_date, collection, time_query_key='TRADE_DT', fact
     time_query_key: str, time key name for query database
     save_list: list with variable your need, make sure your variable is right,
                 default= 'all',get all data
+    use_cache: bool, 在fetch_cache()中时是否使用缓存
+    columnar: bool, 按列读取（见_fetch_columns）：不返回_id，列顺序与factor_ls一致，
+              日期为datetime64，字符串列为category，数值列为float_dtype，必须给定factor_ls
+    float_dtype: columnar=True时数值列的类型，np.float64 or np.float32
+    batch_size: 每次从数据库返回的文档数
+    n_jobs: int, 把日期区间等分为n_jobs段，用多个线程同时读取后按日期顺序拼接（见_fetch_parallel），
+            MongoClient自带连接池，多个线程可以共用同一个client
+    按交易日分桶储存的collection（见to_day_buckets）自动展开为相同格式的长表（_id列为所在分桶文档的_id），
+    读取一天的截面只需要读取一个文档
 
     比如，当我需要从Mongodb数据库中factor数据中获取factor这个collection，需要按照以下命令：
-    client = pymongo.MongoClient(host='localhost', port=27017)
+    client = get_client()
     db = client.factor
     collection = db.factor
 
-    注意 TODO：目前function不能一次取超过3年的数据，否则内存要爆，要取全部年份，需要写循环
+    注意：一次取超过3年的数据内存可能不够，长区间请使用fetch_data_chunks / fetch_data_reduce / fetch_panel
     """
-    if end_date is not None:
-        # 将end-date延后一天，以便形成闭区间
-        end_date = (pd.to_datetime(end_date) + pd.Timedelta(1, unit='d')).strftime('%Y-%m-%d')
-        query = {time_query_key: {"$gte": start_date, "$lte": end_date}}
-    else:
-        query = {time_query_key: {'$gte': start_date}}
+    if use_cache and _FETCH_CACHE is not None:
+        return _fetch_data_cached(start_date, end_date, collection, time_query_key, factor_ls,
+                                  columnar, float_dtype, batch_size, n_jobs)
+    if columnar and factor_ls is None:
+        raise ValueError('factor_ls is required when columnar=True')
+    if n_jobs > 1:
+        return _fetch_parallel(start_date, end_date, collection, time_query_key, factor_ls, n_jobs,
+                               columnar=columnar, float_dtype=float_dtype, batch_size=batch_size)
+
+    # 查询条件按collection中日期的储存格式生成，闭区间
+    query = {time_query_key: _date_query(start_date, end_date, get_date_format(collection, time_query_key) or 'str')}
 
     print('Querying......')
 
+    if get_layout(collection) == 'day':
+        return _fetch_buckets(collection, query, factor_ls, time_query_key, columnar, float_dtype)
+
+    if columnar:
+        return _fetch_columns(collection, query, factor_ls, time_query_key, float_dtype, batch_size)
+
     if factor_ls is not None:
         fields = dict.fromkeys(factor_ls, 1)
         cursor = collection.find(query, fields)
@@ -189,5 +874,274 @@ def fetch_data(start_date, end_date, collection, time_query_key='TRADE_DT', fact
     data = pd.DataFrame.from_records(cursor)
 
     if len(data) != 0:
-        data[time_query_key] = pd.to_datetime(data[time_query_key])
+        data[time_query_key] = decode_dates(data[time_query_key].values)
+    return data
+
+
+def split_periods(start_date, end_date, freq='y') -> list:
+    """
+    把[start_date, end_date]按自然月（m）、季（q）或年（y）切分为互不重叠的闭区间
+
+    :return: [(sdt, edt)]，均为'YYYY-MM-DD'
+    """
+    freq_dict = {'m': 'MS', 'q': 'QS', 'y': 'YS'}
+    if freq not in freq_dict:
+        raise NotImplementedError(f'please enter the right freq: {list(freq_dict.keys())}')
+    sdt, edt = pd.to_datetime(start_date).normalize(), pd.to_datetime(end_date).normalize()
+    if sdt > edt:
+        return []
+    starts = [sdt] + [x for x in pd.date_range(sdt, edt, freq=freq_dict[freq]) if x > sdt]
+    ends = [x - pd.Timedelta(1, unit='d') for x in starts[1:]] + [edt]
+    return [(s.strftime('%Y-%m-%d'), e.strftime('%Y-%m-%d')) for s, e in zip(starts, ends)]
+
+
+def fetch_data_chunks(start_date, end_date, collection, time_query_key='TRADE_DT', factor_ls=None, freq='y',
+                      **kwargs):
+    """
+    fetch_data的流式版本：按自然月（m）、季（q）或年（y）逐段读取并yield，内存中同时只有一段长表数据
+    在fetch_cache()中时整段读取（进入缓存），再按周期切分yield
+
+    :param freq: 每段的长度，'m', 'q' or 'y'
+    :param end_date: None表示取到数据库中最新的日期
+    :param kwargs: 传给fetch_data的其他参数，如columnar, float_dtype
+    """
+    if end_date is None:
+        end_date = get_newest_date(collection, time_query_key)
+        if end_date is None:
+            return
+        end_date = parse_date(end_date).strftime('%Y-%m-%d')
+
+    if _FETCH_CACHE is not None and kwargs.get('use_cache', True):
+        data = fetch_data(start_date, end_date, collection, time_query_key, factor_ls, **kwargs)
+        for sdt, edt in split_periods(start_date, end_date, freq):
+            mask = (data[time_query_key] >= pd.to_datetime(sdt)) & \
+                   (data[time_query_key] < pd.to_datetime(edt) + pd.Timedelta(1, unit='d'))
+            if mask.any():
+                yield data[mask].reset_index(drop=True)
+        return
+
+    kwargs['use_cache'] = False
+    for sdt, edt in split_periods(start_date, end_date, freq):
+        data = fetch_data(sdt, edt, collection, time_query_key, factor_ls, **kwargs)
+        if len(data) != 0:
+            yield data
+
+
+def fetch_data_reduce(start_date, end_date, collection, reducer, initial=None, time_query_key='TRADE_DT',
+                      factor_ls=None, freq='y', **kwargs):
+    """
+    按段读取数据并依次归约：result = reducer(result, chunk)，用于逐段计算、维护滚动窗口或逐段写入磁盘
+
+    reducer = lambda acc, chunk: acc + [chunk.groupby('TRADE_DT')['adj_pct_chg'].mean()]
+    daily_mean = pd.concat(fetch_data_reduce(sdt, edt, collection, reducer, initial=[],
+                                             factor_ls=['TRADE_DT', 'adj_pct_chg']))
+
+    :param reducer: callable(result, chunk) -> result
+    :param initial: result的初始值
+    :return: 归约后的result
+    """
+    result = initial
+    for chunk in fetch_data_chunks(start_date, end_date, collection, time_query_key, factor_ls, freq, **kwargs):
+        result = reducer(result, chunk)
+    return result
+
+
+def fetch_panel(start_date, end_date, collection, field, time_query_key='TRADE_DT', id_key='S_INFO_WINDCODE',
+                freq='y', float_dtype=np.float64, n_jobs=1):
+    """
+    按段读取并直接生成 日期 × ticker 的矩阵，不经过MultiIndex的unstack：
+        * 每段只保留日期行号、ticker列号（整数）和数值，长表数据每次只保留一段
+        * 全部读取后一次性按整数下标写入预先分配的矩阵，多个字段共用同一组行号、列号
+
+    :param field: 字段名，或字段名列表（一次读取多个字段）
+    :param id_key: ticker字段名
+    :param freq: 每段的长度，见fetch_data_chunks
+    :param n_jobs: 每段读取时的线程数，见fetch_data
+    :return: field为字段名时返回DataFrame，index为日期，columns为ticker（升序）；
+             field为列表时返回{字段名: DataFrame}，所有矩阵的行列相同
+    """
+    fields = [field] if isinstance(field, str) else list(field)
+
+    dates, rows, cols = [], [], []
+    values = {f: [] for f in fields}
+    tickers = {}
+    n_dates = 0
+    for chunk in fetch_data_chunks(start_date, end_date, collection, time_query_key,
+                                   [time_query_key, id_key] + fields, freq,
+                                   columnar=True, float_dtype=float_dtype, n_jobs=n_jobs):
+        chunk = chunk.dropna(subset=[time_query_key, id_key])
+        # 行号：段内去重后的日期（各段的日期互不重叠且递增）
+        chunk_dates, row = np.unique(chunk[time_query_key].values, return_inverse=True)
+        # 列号：只对每段去重后的ticker查表
+        codes = pd.Categorical(chunk[id_key])
+        ids = np.array([tickers.setdefault(code, len(tickers)) for code in codes.categories], dtype=np.int64)
+
+        dates.append(chunk_dates)
+        rows.append(row.reshape(-1) + n_dates)
+        cols.append(ids[codes.codes])
+        for f in fields:
+            values[f].append(chunk[f].values)
+        n_dates += len(chunk_dates)
+
+    # ticker按升序排列，与unstack的结果一致
+    names = np.array(list(tickers), dtype=object)
+    order = np.argsort(names, kind='stable')
+    position = np.empty(len(order), dtype=np.int64)
+    position[order] = np.arange(len(order))
+
+    index = pd.DatetimeIndex(np.concatenate(dates) if dates else [], name=time_query_key)
+    columns = list(names[order])
+    row = np.concatenate(rows) if rows else np.array([], dtype=np.int64)
+    col = position[np.concatenate(cols)] if cols else np.array([], dtype=np.int64)
+
+    panels = {}
+    for f in fields:
+        panel = np.full((len(index), len(columns)), np.nan, dtype=float_dtype)
+        if len(row):
+            panel[row, col] = np.concatenate(values[f])
+        panels[f] = pd.DataFrame(panel, index=index, columns=columns, copy=False)
+    return panels[field] if isinstance(field, str) else panels
+
+
+def _fetch_columns(collection, query, factor_ls, time_query_key='TRADE_DT', float_dtype=np.float64,
+                   batch_size=50000) -> pd.DataFrame:
+    """
+    按列读取数据：
+        * 服务端排除_id，只返回factor_ls中的字段
+        * 安装了pymongoarrow时直接解码为arrow列，不生成逐行的python对象；否则从游标按批读取
+        * 日期字符串只解析去重后的值，字符串列转为category，数值列转为float_dtype
+    """
+    projection = dict.fromkeys(factor_ls, 1)
+    projection['_id'] = 0
+
+    if find_arrow_all is not None:
+        data = find_arrow_all(collection, query, projection=projection).to_pandas()
+    else:
+        cursor = collection.find(query, projection).batch_size(batch_size)
+        data = pd.DataFrame.from_records(cursor, columns=factor_ls)
+    return _to_columns(data, factor_ls, time_query_key, float_dtype)
+
+
+def _fetch_buckets(collection, query, factor_ls=None, time_query_key='TRADE_DT', columnar=False,
+                   float_dtype=np.float64) -> pd.DataFrame:
+    """
+    读取按交易日分桶的collection，展开为与逐行储存时相同的长表，按日期升序
+    """
+    projection = None if factor_ls is None else {**dict.fromkeys(factor_ls, 1), '_n': 1, '_id': int(not columnar)}
+    cursor = collection.find(query, projection).sort(time_query_key, pymongo.ASCENDING)
+    data = from_day_buckets(cursor, factor_ls)
+    if columnar:
+        return _to_columns(data, factor_ls, time_query_key, float_dtype)
+    if len(data) != 0:
+        data[time_query_key] = decode_dates(data[time_query_key].values)
     return data
+
+
+def _to_columns(data, factor_ls, time_query_key='TRADE_DT', float_dtype=np.float64) -> pd.DataFrame:
+    """
+    按列转换类型：日期见decode_dates，字符串列转为category，数值列转为float_dtype
+    """
+    out = {}
+    for col in factor_ls:
+        values = data[col].values if col in data.columns else np.full(len(data), np.nan)
+        if col == time_query_key:
+            out[col] = decode_dates(values)
+        elif pd.api.types.infer_dtype(values, skipna=True) == 'string':
+            out[col] = pd.Categorical(values)
+        else:
+            out[col] = pd.to_numeric(values, errors='coerce').astype(float_dtype)
+    return pd.DataFrame(out, columns=factor_ls)
+
+
+def benchmark_fetch(start_date, end_date, collection, factor_ls, time_query_key='TRADE_DT', repeat=3) -> pd.DataFrame:
+    """
+    比较逐行读取（fetch_data默认）和按列读取（columnar=True）的耗时与内存
+
+    :return: DataFrame，index为读取方式，列为最短耗时（秒）、行数和内存（MB）
+    """
+    result = {}
+    for name, kwargs in [('records', {}), ('columnar', {'columnar': True}),
+                         ('columnar_float32', {'columnar': True, 'float_dtype': np.float32})]:
+        times = []
+        for _ in range(repeat):
+            t0 = time.perf_counter()
+            data = fetch_data(start_date, end_date, collection, time_query_key, factor_ls, use_cache=False, **kwargs)
+            times.append(time.perf_counter() - t0)
+        result[name] = {'seconds': min(times), 'rows': len(data),
+                        'memory_mb': data.memory_usage(deep=True).sum() / 2 ** 20}
+    return pd.DataFrame(result).T
+
+
+def split_range(start_date, end_date, n) -> list:
+    """
+    把[start_date, end_date]按自然日等分为不超过n个互不重叠的闭区间
+
+    :return: [(sdt, edt)]，均为'YYYY-MM-DD'
+    """
+    days = pd.date_range(pd.to_datetime(start_date).normalize(), pd.to_datetime(end_date).normalize(), freq='D')
+    return [(part[0].strftime('%Y-%m-%d'), part[-1].strftime('%Y-%m-%d'))
+            for part in np.array_split(days, min(n, len(days))) if len(part)]
+
+
+def _fetch_parallel(start_date, end_date, collection, time_query_key='TRADE_DT', factor_ls=None, n_jobs=4,
+                    **kwargs) -> pd.DataFrame:
+    """
+    多线程分段读取：日期区间等分为n_jobs段，每段一个游标，结果按日期顺序拼接。
+    读取时间主要在等待数据库和解码BSON，pymongo在网络IO时释放GIL
+    """
+    if end_date is None:
+        end_date = get_newest_date(collection, time_query_key)
+        if end_date is None:
+            return pd.DataFrame()
+        end_date = parse_date(end_date).strftime('%Y-%m-%d')
+
+    ranges = split_range(start_date, end_date, n_jobs)
+    with ThreadPoolExecutor(max_workers=len(ranges) or 1) as executor:
+        chunks = list(executor.map(
+            lambda r: fetch_data(r[0], r[1], collection, time_query_key, factor_ls, use_cache=False, **kwargs),
+            ranges))
+
+    chunks = [chunk for chunk in chunks if len(chunk) != 0]
+    if len(chunks) == 0:
+        return pd.DataFrame(columns=factor_ls) if kwargs.get('columnar') else pd.DataFrame()
+    data = pd.concat(chunks, ignore_index=True)
+    # 每段的category不同，拼接后恢复为category
+    for col in chunks[0].columns:
+        if isinstance(chunks[0][col].dtype, pd.CategoricalDtype):
+            data[col] = pd.api.types.union_categoricals([chunk[col] for chunk in chunks], sort_categories=True)
+    return data
+
+
+def _fetch_data_cached(start_date, end_date, collection, time_query_key='TRADE_DT', factor_ls=None,
+                       columnar=False, float_dtype=np.float64, batch_size=50000, n_jobs=1):
+    """
+    fetch_data的缓存版本：缓存未覆盖请求区间时，读取两者的并集并替换缓存
+    """
+    key = (collection.full_name, time_query_key, None if factor_ls is None else tuple(sorted(factor_ls)),
+           columnar, np.dtype(float_dtype).name if columnar else None)
+    sdt = pd.to_datetime(start_date)
+    # end_date为None表示取到最新
+    edt = None if end_date is None else pd.to_datetime(end_date)
+
+    cached = _FETCH_CACHE.get(key)
+    if cached is None:
+        cover = (sdt, edt)
+    else:
+        cover = (min(sdt, cached[0]), None if edt is None or cached[1] is None else max(edt, cached[1]))
+
+    if cached is None or cover != cached[:2]:
+        data = fetch_data(cover[0].strftime('%Y-%m-%d'),
+                          None if cover[1] is None else cover[1].strftime('%Y-%m-%d'),
+                          collection, time_query_key, factor_ls, use_cache=False,
+                          columnar=columnar, float_dtype=float_dtype, batch_size=batch_size, n_jobs=n_jobs)
+        _FETCH_CACHE[key] = cached = (cover[0], cover[1], data)
+    else:
+        print(f'Using cached {collection.full_name}......')
+
+    data = cached[2]
+    if len(data) == 0:
+        return data.copy()
+    mask = data[time_query_key] >= sdt
+    if edt is not None:
+        mask &= data[time_query_key] < edt.normalize() + pd.Timedelta(1, unit='d')
+    return data[mask].reset_index(drop=True)
@@ -0,0 +1,316 @@
+# -*- coding:utf-8 -*-
+"""
+@author: lzy <liuzhy.20@pbcsf.tsinghua.edu.cn>
+@file: parallel_utils.py
+@time:2022/01/08
+因子平台的并行计算辅助库：管理进程池worker中可见的因子对象，以及用共享内存传递数据矩阵，
+避免每个任务都pickle整个因子对象。
+"""
+import os
+import copy
+import pickle
+import warnings
+import numpy as np
+import pandas as pd
+import multiprocessing
+from multiprocessing import shared_memory
+from multiprocessing.pool import ThreadPool
+
+try:
+    from threadpoolctl import threadpool_limits
+except ImportError:
+    threadpool_limits = None
+
+# worker进程中可见的因子对象，key为因子名（因子名必须唯一）
+_WORKER_FACTORS = {}
+
+# 可选的数据共享方式
+SHARE_MODES = ['pickle', 'fork', 'shm']
+
+# 可选的执行方式
+EXECUTORS = ['process', 'thread', 'serial']
+
+# BLAS/OpenMP线程数对应的环境变量，没有安装threadpoolctl时只对之后新启动的进程有效
+BLAS_ENV_VARS = ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS', 'VECLIB_MAXIMUM_THREADS']
+
+
+class SharedPanel(object):
+    __doc__ = """
+    共享内存中的数据矩阵：
+        * 主进程中把数值型DataFrame的values拷贝进共享内存，pickle时只传递名称、shape、dtype和行列标签
+        * worker中调用attach()，零拷贝地重建DataFrame
+    """
+
+    def __init__(self, df: pd.DataFrame) -> None:
+        values = np.ascontiguousarray(df.values)
+        self._shm = shared_memory.SharedMemory(create=True, size=max(values.nbytes, 1))
+        np.ndarray(values.shape, dtype=values.dtype, buffer=self._shm.buf)[:] = values
+        self.name = self._shm.name
+        self.shape = values.shape
+        self.dtype = values.dtype
+        self.index = df.index
+        self.columns = df.columns
+        return
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_shm'] = None
+        return state
+
+    def attach(self) -> pd.DataFrame:
+        """
+        在worker中连接共享内存，返回与主进程数据相同的DataFrame（不拷贝）
+        """
+        try:
+            self._shm = shared_memory.SharedMemory(name=self.name, track=False)
+        except TypeError:
+            # python < 3.13 没有track参数
+            self._shm = shared_memory.SharedMemory(name=self.name)
+        values = np.ndarray(self.shape, dtype=self.dtype, buffer=self._shm.buf)
+        return pd.DataFrame(values, index=self.index, columns=self.columns, copy=False)
+
+    def release(self) -> None:
+        """
+        主进程中释放共享内存
+        """
+        if self._shm is not None:
+            self._shm.close()
+            self._shm.unlink()
+            self._shm = None
+
+
+def is_shareable(data) -> bool:
+    """
+    判断一个属性能否放入共享内存：只支持单一数值类型的DataFrame（如unstack之后的EOD矩阵）
+    """
+    if not isinstance(data, pd.DataFrame) or data.empty:
+        return False
+    dtypes = set(data.dtypes)
+    return len(dtypes) == 1 and np.issubdtype(dtypes.pop(), np.number)
+
+
+def share_factor(factor):
+    """
+    生成因子对象的浅拷贝，其中所有可共享的数据矩阵都替换为SharedPanel
+
+    :param factor: 因子对象
+    :return: (因子对象的浅拷贝, SharedPanel列表)
+    """
+    skeleton = copy.copy(factor)
+    panels = []
+    for attr, value in vars(factor).items():
+        if is_shareable(value):
+            panel = SharedPanel(value)
+            setattr(skeleton, attr, panel)
+            panels.append(panel)
+    return skeleton, panels
+
+
+def register_factor(factor) -> None:
+    """
+    在当前进程中登记因子对象，fork出的worker会继承登记结果
+    """
+    _WORKER_FACTORS[factor.get_factor_name()] = factor
+
+
+def unregister_factor(factor_name: str) -> None:
+    """
+    取消登记因子对象
+    """
+    _WORKER_FACTORS.pop(factor_name, None)
+
+
+class SerialPool(object):
+    __doc__ = """
+    与multiprocessing.Pool接口一致的串行执行器，apply_async时直接在当前进程中计算，用于调试和小规模计算
+    """
+
+    def apply_async(self, func, args=(), callback=None, error_callback=None) -> None:
+        try:
+            result = func(*args)
+        except Exception as e:
+            if error_callback is not None:
+                error_callback(e)
+        else:
+            if callback is not None:
+                callback(result)
+
+    def close(self) -> None:
+        return
+
+    def join(self) -> None:
+        return
+
+
+class BlasLimit(object):
+    __doc__ = """
+    限制BLAS/OpenMP的线程数，避免多个worker各自开满线程导致的超额订阅：
+        * 安装了threadpoolctl时直接限制当前进程（fork出的worker会继承）
+        * 同时设置环境变量，对之后新启动的worker进程有效
+        * 没有安装threadpoolctl时当前进程（线程池、fork出的worker）已经加载的BLAS不受限制，发出警告
+        * release()时恢复原来的设置
+    """
+
+    def __init__(self, n_threads: int, warn=True) -> None:
+        """
+        :param n_threads: 每个进程的BLAS线程数
+        :param warn: 没有安装threadpoolctl时是否警告，worker中由主进程统一警告
+        """
+        self._environ = {var: os.environ.get(var) for var in BLAS_ENV_VARS}
+        os.environ.update({var: str(n_threads) for var in BLAS_ENV_VARS})
+        self._limiter = None
+        if threadpool_limits is not None:
+            self._limiter = threadpool_limits(limits=n_threads)
+        elif warn:
+            warnings.warn(f'threadpoolctl is not installed, BLAS threads of the current process are not limited '
+                          f'to {n_threads} (only newly started processes are), pip install threadpoolctl',
+                          RuntimeWarning, stacklevel=2)
+        return
+
+    def release(self) -> None:
+        if self._limiter is not None:
+            self._limiter.restore_original_limits()
+            self._limiter = None
+        for var, value in self._environ.items():
+            if value is None:
+                os.environ.pop(var, None)
+            else:
+                os.environ[var] = value
+        self._environ = {}
+
+
+def blas_threads(process: int) -> int:
+    """
+    每个worker可以使用的BLAS线程数
+    """
+    return max(1, (os.cpu_count() or 1) // max(process, 1))
+
+
+def init_worker(n_threads: int, *skeletons) -> None:
+    """
+    worker进程初始化函数：限制BLAS线程数，连接共享内存中的数据矩阵，并登记因子对象
+    """
+    BlasLimit(n_threads, warn=False)
+    for skeleton in skeletons:
+        for attr, value in list(vars(skeleton).items()):
+            if isinstance(value, SharedPanel):
+                setattr(skeleton, attr, value.attach())
+        register_factor(skeleton)
+
+
+def run_factor_task(factor_name: str, method: str, *args):
+    """
+    worker中执行的任务：从登记的因子对象中调用对应方法，任务本身只传递因子名、方法名和参数
+    """
+    return getattr(_WORKER_FACTORS[factor_name], method)(*args)
+
+
+def resolve_share_mode(share_mode=None) -> str:
+    """
+    确定数据共享方式，默认在支持fork的系统上使用fork，否则使用共享内存
+    """
+    if share_mode is None:
+        share_mode = 'fork' if 'fork' in multiprocessing.get_all_start_methods() else 'shm'
+    if share_mode not in SHARE_MODES:
+        raise NotImplementedError(f'please enter the right share_mode: {SHARE_MODES}')
+    return share_mode
+
+
+def resolve_executor(executor='process') -> str:
+    """
+    检查执行方式
+    """
+    if executor not in EXECUTORS:
+        raise NotImplementedError(f'please enter the right executor: {EXECUTORS}')
+    return executor
+
+
+def create_pool(process: int, share_mode: str, factors: list, executor='process'):
+    """
+    创建进程池（或线程池），多个因子可以共用一个池
+
+    :param process: 进程数（线程数）
+    :param share_mode: 数据共享方式，见resolve_share_mode，只对executor='process'有效
+    :param factors: 会向池发送任务的因子对象，必须已经运行了prepare_data()
+    :param executor: 执行方式：
+        * 'process': 多进程
+        * 'thread': 多线程，所有线程直接读取主进程中的数据，适合numpy/scipy/BLAS等释放GIL的计算
+        * 'serial': 在当前进程中串行计算
+    :return: (池, 需要释放的资源列表)，用完后调用release_pool
+    """
+    if executor == 'serial':
+        return SerialPool(), []
+
+    # 线程共享同一个进程的BLAS线程池，只能整体限制；进程在worker初始化时再各自限制一次
+    n_threads = blas_threads(process)
+    resources = [BlasLimit(n_threads)]
+    if executor == 'thread':
+        return ThreadPool(process), resources
+
+    if share_mode == 'pickle':
+        # 每个任务都pickle整个因子对象
+        pool = multiprocessing.Pool(process, initializer=init_worker, initargs=(n_threads,))
+    elif share_mode == 'fork':
+        # worker通过fork直接继承主进程中已经准备好的数据
+        for factor in factors:
+            register_factor(factor)
+        pool = multiprocessing.get_context('fork').Pool(
+            process, initializer=init_worker, initargs=(n_threads,))
+    else:
+        # 数据矩阵放入共享内存，因子对象只在worker初始化时传递一次
+        skeletons = []
+        for factor in factors:
+            skeleton, factor_panels = share_factor(factor)
+            skeletons.append(skeleton)
+            resources.extend(factor_panels)
+        pool = multiprocessing.Pool(process, initializer=init_worker, initargs=(n_threads,) + tuple(skeletons))
+    return pool, resources
+
+
+def release_pool(factors: list, resources: list) -> None:
+    """
+    池结束后取消因子登记，释放共享内存和BLAS线程限制
+    """
+    for factor in factors:
+        unregister_factor(factor.get_factor_name())
+    for resource in resources:
+        resource.release()
+
+
+def auto_block_size(n_days: int, process: int) -> int:
+    """
+    自动确定每个任务的交易日数：每个进程大约分到4个任务，兼顾任务开销和负载均衡
+    """
+    return max(1, int(np.ceil(n_days / (max(process, 1) * 4))))
+
+
+def split_blocks(trading_days: list, block_size: int, skip=None) -> list:
+    """
+    把交易日切分为长度不超过block_size的连续块
+
+    :param trading_days: 交易日列表
+    :param block_size: 每块的交易日数
+    :param skip: 不需要计算的交易日集合，块在这些交易日处断开
+    :return: list of list
+    """
+    if not skip:
+        return [trading_days[i:i + block_size] for i in range(0, len(trading_days), block_size)]
+
+    blocks, block = [], []
+    for dt in trading_days:
+        if dt in skip or len(block) == block_size:
+            if block:
+                blocks.append(block)
+            block = []
+        if dt not in skip:
+            block.append(dt)
+    if block:
+        blocks.append(block)
+    return blocks
+
+
+def task_ipc_bytes(func, args) -> int:
+    """
+    计算一个进程池任务发送给worker的字节数（pickle之后的大小）
+    """
+    return len(pickle.dumps((func, args), protocol=pickle.HIGHEST_PROTOCOL))
@@ -0,0 +1,85 @@
+# -*- coding:utf-8 -*-
+"""
+generate_factor_panel与逐日generate_factor的结果一致性测试
+交易日历和数据矩阵使用合成数据，不需要连接数据库
+
+运行：python -m pytest tests
+"""
+import os
+import sys
+import importlib
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import Helper
+from BaseFactor import BaseFactor
+
+DATES = pd.bdate_range('2020-01-01', periods=120)
+LAG = 20
+
+# (模块, 因子类, 数据矩阵的属性名)
+PANEL_FACTORS = [
+    ('f00009_idvff', 'IDVFF', 'EOD'),
+    ('f00010_idvc', 'IDVC', 'EOD'),
+    ('f00011_turn', 'TURN', 'turnovr'),
+    ('f00012_abtrun', 'ABTURN', 'turnovr'),
+    ('f00013_idsc', 'IDSC', 'EOD'),
+    ('f00014_ts', 'TS', 'EOD'),
+    ('f00016_im', 'IM', 'EOD'),
+]
+
+
+@pytest.fixture(autouse=True)
+def trade_date(monkeypatch):
+    """
+    用合成的交易日替换数据库中的交易日历
+    """
+    monkeypatch.setattr(Helper.TradeDate, '_TradeDate__load_dts',
+                        staticmethod(lambda cache_path=None: DATES.values))
+    monkeypatch.setattr(Helper, '_TRADE_DATE', Helper.TradeDate(check_update=False, cache_path=None))
+
+
+def make_panel(attr, seed=0) -> pd.DataFrame:
+    """
+    合成数据矩阵，包含：
+        * 随机缺失的格子和缺失过多的股票
+        * 窗口内数值相同（方差为0）的股票
+        * 换手率中流通股本为0时产生的inf
+    """
+    rng = np.random.default_rng(seed)
+    codes = [f'{i:06d}.SZ' for i in range(12)]
+    if attr == 'turnovr':
+        values = rng.uniform(0.001, 0.05, (len(DATES), len(codes)))
+    else:
+        values = rng.normal(0, 0.02, (len(DATES), len(codes)))
+    values[rng.random(values.shape) < 0.1] = np.nan
+    values[:, 1] = np.nan
+    values[::2, 1] = 0.01
+    values[:, 2] = 0.01
+    values[40:70, 3] = 0.01
+    if attr == 'turnovr':
+        values[50, 4] = np.inf
+        values[90, 5] = np.inf
+        values[91:93, 5] = np.nan
+    return pd.DataFrame(values, index=DATES, columns=codes)
+
+
+@pytest.mark.parametrize('module, cls, attr', PANEL_FACTORS)
+def test_panel_equals_daily(module, cls, attr):
+    factor = getattr(importlib.import_module(module), cls)(
+        factor_parameters={'lagTradeDays': LAG, 'factor_input': 'f00001'})
+    assert factor.has_panel()
+    panel = make_panel(attr)
+    setattr(factor, attr, panel)
+    factor.ordinals = factor.TD.ordinal(panel.index)
+    factor.codes = list(panel.columns)
+
+    days = factor.get_trading_days(DATES[LAG].strftime('%Y-%m-%d'), DATES[-1].strftime('%Y-%m-%d'))
+    daily = factor.generate_factor_batch(days).reindex(columns=factor.codes)
+    out = factor.generate_factor_panel(days[0], days[-1])
+    out.index = out.index.strftime('%Y-%m-%d')
+    out = out.reindex(index=days, columns=factor.codes)
+
+    np.testing.assert_allclose(out.values, daily.values, rtol=1e-7, atol=1e-10, equal_nan=True)